@@ -0,0 +1,94 @@
+import os
+import shutil
+import time
+import zlib
+from zipfile import ZipFile, BadZipFile, ZIP_DEFLATED, ZIP_STORED
+
+from utils import get_current_dir, get_temp_path
+
+SAMPLE_SIZE = 64 * 1024  # bytes read to decide if an entry is worth deflating
+MIN_DEFLATE_GAIN = 0.1  # deflate only if it saves at least 10% on the sample
+
+
+def get_zip_path(path):
+    """
+    Get the path of the zip created for a directory
+    :param path: zipped directory
+    :return: path of the zip inside the directory
+    """
+    return os.path.join(path, get_current_dir(path)) + ".zip"
+
+
+def zip_dir(path, files):
+    """
+    Compress images in the specified directory
+    Sub directories are ignored
+    Create one zip per folder, or update the existing one: new images are appended, and the zip is rebuilt
+    only if images were removed or changed, as an entry cannot be replaced without leaving a duplicate behind
+    The zip is written to a temporary file first, a copy of the existing zip when appending, and replaces it
+    once complete, so an interrupted run never leaves a broken zip behind
+
+    :param path: directory to get files in
+    :param files: {image name: ImageStat} of the images to put in the zip
+    :return: measures: seconds spent and bytes read and written, see RunStats.add_measures
+    """
+    start = time.perf_counter()
+    zip_path = get_zip_path(path)
+    names = list(files)
+    mode = "w"
+    if os.path.exists(zip_path):
+        try:
+            with ZipFile(zip_path) as zip_file:
+                zipped = {info.filename: (info.file_size, info.date_time) for info in zip_file.infolist()}
+        except (BadZipFile, OSError):
+            zipped = None  # unreadable zip, rebuild it
+        if zipped is not None and all(fn in files and (files[fn].size, get_zip_date_time(files[fn])) == zipped[fn]
+                                      for fn in zipped):
+            mode = "a"
+            names = [fn for fn in names if fn not in zipped]
+    if mode == "a" and len(names) == 0:
+        return {"zip": time.perf_counter() - start}
+    print(("Updating" if mode == "a" else "Creating") + " .zip '" + path + "'")
+    temp_path = get_temp_path(zip_path)
+    try:
+        if mode == "a":
+            shutil.copyfile(zip_path, temp_path)
+        with ZipFile(temp_path, mode, ZIP_DEFLATED) as zip_file:
+            for fn in names:
+                absolute_file_name = os.path.join(path, fn)
+                zip_file.write(absolute_file_name, fn, get_compress_type(absolute_file_name))
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    os.replace(temp_path, zip_path)
+    input_bytes = sum(files[fn].size for fn in names)
+    return {"zip": time.perf_counter() - start, "read_bytes": input_bytes, "zip_input_bytes": input_bytes,
+            "zip_output_bytes": os.path.getsize(zip_path)}
+
+
+def get_zip_date_time(stat):
+    """
+    Get the date stored in a zip for a file, zips only keep local time with a 2 seconds resolution
+
+    :param stat: ImageStat of the file
+    :return: (year, month, day, hour, minute, second)
+    """
+    date_time = time.localtime(stat.mtime // 1000000000)[0:6]
+    return date_time[0:5] + (date_time[5] - date_time[5] % 2,)
+
+
+def get_compress_type(path):
+    """
+    Choose how to store a file in a zip: JPEG and PNG data is already compressed, so it is stored as is
+    unless deflating a sample of the file shows it actually helps (large uncompressed metadata for example)
+
+    :param path: file to store
+    :return: ZIP_STORED or ZIP_DEFLATED
+    """
+    with open(path, "rb") as file:
+        sample = file.read(SAMPLE_SIZE)
+    if len(sample) == 0:
+        return ZIP_STORED
+    gain = 1 - len(zlib.compress(sample, 1)) / len(sample)
+    return ZIP_DEFLATED if gain >= MIN_DEFLATE_GAIN else ZIP_STORED
@@ -0,0 +1,223 @@
+#!/usr/bin/python3
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import PIL
+from PIL import Image, ImageDraw, ImageFilter
+
+from optimizer import ImageOptimizer
+from scanner import Scanner
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+STAGES = ["scan", "compress", "zip", "thumb", "all"]
+
+
+def generate_gallery(path, depth, dirs, images, width, height, formats, seed=0):
+    """
+    Generate a synthetic gallery tree, the same arguments always give the same gallery
+
+    :param path: directory to create the gallery in, removed first if it exists
+    :param depth: number of directory levels below the root
+    :param dirs: number of sub directories in each directory
+    :param images: number of images in each directory
+    :param width: images width
+    :param height: images height
+    :param formats: list of file extensions to pick from (jpg, png)
+    :param seed: random seed
+    :return: number of images created
+    """
+    shutil.rmtree(path, ignore_errors=True)
+    rng = random.Random(seed)
+    count = 0
+    level = [path]
+    for current_depth in range(depth + 1):
+        next_level = []
+        for directory in level:
+            os.makedirs(directory, exist_ok=True)
+            for i in range(images):
+                image_format = formats[rng.randrange(len(formats))]
+                img = generate_image(width, height, rng)
+                filename = os.path.join(directory, "image" + str(i) + "." + image_format)
+                if image_format in ("jpg", "jpeg"):
+                    img.save(filename, "JPEG", quality=95)
+                else:
+                    img.save(filename, "PNG")
+                count += 1
+            if current_depth < depth:
+                next_level += [os.path.join(directory, "dir" + str(i)) for i in range(dirs)]
+        level = next_level
+    return count
+
+
+def generate_image(width, height, rng):
+    """
+    Generate a photo-like image: smooth colored shapes with a little noise, so it compresses like a real photo
+
+    :param width: image width
+    :param height: image height
+    :param rng: random.Random used to draw the image
+    :return: RGB image
+    """
+    img = Image.new("RGB", (width, height), tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(img)
+    for _ in range(20):
+        x, y = rng.randrange(width), rng.randrange(height)
+        radius = rng.randrange(1, max(2, width // 3))
+        draw.ellipse((x - radius, y - radius, x + radius, y + radius), tuple(rng.randrange(256) for _ in range(3)))
+    img = img.filter(ImageFilter.GaussianBlur(max(1, width // 100)))
+    noise = Image.frombytes("L", (width, height), rng.getrandbits(8 * width * height).to_bytes(width * height, "little"))
+    return Image.blend(img, noise.convert("RGB"), 0.1)
+
+
+def get_gallery_size(path):
+    """
+    Get the total size of the images in a gallery
+
+    :param path: gallery directory
+    :return: size in bytes
+    """
+    total = 0
+    for root, dirs, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, fn)) for fn in files)
+    return total
+
+
+def get_peak_rss():
+    """
+    Get the peak memory used by this process and by its finished children (worker processes)
+    :return: (self peak, children peak) in kilobytes, None if not available on this platform
+    """
+    if resource is None:
+        return None, None
+    scale = 1024 if sys.platform == "darwin" else 1  # bytes on macOS, kilobytes elsewhere
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale)
+
+
+def run_stage(stage, gallery, workers):
+    """
+    Time one stage on a gallery, in this process
+
+    :param stage: one of STAGES
+    :param gallery: gallery directory, modified by the stage
+    :param workers: number of worker processes given to the optimizer
+    :return: dict of measures
+    """
+    input_size = get_gallery_size(gallery)
+    scan_start = time.perf_counter()
+    scanner = Scanner(gallery)
+    scan_result = []
+    scanner.signals.scan_finished_signal.connect(scan_result.append)
+    scanner.run()
+    scan_result = scan_result[0]
+    start = time.perf_counter()
+    report = None
+    if stage != "scan":
+        optimizer = ImageOptimizer(scan_result.get_dir_list(), scan_result.image_list, gallery, gallery + "_thumb",
+                                   stage in ("compress", "all"), stage in ("zip", "all"), stage in ("thumb", "all"),
+                                   30, workers, False, images=scan_result.images)
+        optimizer.run()
+        report = optimizer.report
+    if stage in ("scan", "all"):
+        start = scan_start  # the end to end run includes the scan
+    seconds = time.perf_counter() - start
+    peak_rss, children_peak_rss = get_peak_rss()
+    return {
+        "seconds": seconds,
+        "images": scan_result.image_count,
+        "directories": len(scan_result.images),
+        "images_per_sec": scan_result.image_count / seconds if seconds > 0 else None,
+        "input_mb": input_size / 1000000,
+        "mb_per_sec": input_size / 1000000 / seconds if seconds > 0 else None,
+        "output_mb": get_gallery_size(gallery) / 1000000,
+        "peak_rss_kb": peak_rss,
+        "workers_peak_rss_kb": children_peak_rss,
+        "report": report,  # per stage breakdown of the optimizer
+    }
+
+
+def create_parser():
+    """
+    Create the command line arguments parser
+    :return: parser
+    """
+    parser = argparse.ArgumentParser(description="Time the scan, compress, zip and thumbnail stages on a synthetic "
+                                                 "gallery, and print the results as JSON")
+    parser.add_argument("--depth", type=int, default=1, help="directory levels below the root (default: 1)")
+    parser.add_argument("--dirs", type=int, default=3, help="sub directories per directory (default: 3)")
+    parser.add_argument("--images", type=int, default=10, help="images per directory (default: 10)")
+    parser.add_argument("--width", type=int, default=1600, help="images width (default: 1600)")
+    parser.add_argument("--height", type=int, default=1200, help="images height (default: 1200)")
+    parser.add_argument("--formats", default="jpg", help="comma separated image formats (default: jpg)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the generated gallery (default: 0)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="number of worker processes (default: CPU count)")
+    parser.add_argument("--stages", default=",".join(STAGES), help="comma separated stages to run (default: all)")
+    parser.add_argument("--output", help="file to write the JSON results to, printed if not given")
+    parser.add_argument("--run-stage", choices=STAGES, help=argparse.SUPPRESS)  # internal: time one stage
+    parser.add_argument("--gallery", help=argparse.SUPPRESS)  # internal: gallery of --run-stage
+    return parser
+
+
+def main(argv=None):
+    """
+    Generate the gallery and time each stage in a separate process, so peak memory is measured per stage
+    :param argv: command line arguments, sys.argv by default
+    :return: exit code
+    """
+    args = create_parser().parse_args(argv)
+    if args.run_stage is not None:
+        print(json.dumps(run_stage(args.run_stage, args.gallery, args.workers)))
+        return 0
+
+    work_dir = tempfile.mkdtemp(prefix="gallery_benchmark_")
+    try:
+        template = os.path.join(work_dir, "template")
+        start = time.perf_counter()
+        generate_gallery(template, args.depth, args.dirs, args.images, args.width, args.height,
+                         args.formats.split(","), args.seed)
+        print("Gallery generated in " + str(round(time.perf_counter() - start, 2)) + "s", file=sys.stderr)
+        results = {
+            "config": {key: value for key, value in vars(args).items()
+                       if key not in ("run_stage", "gallery", "output", "stages")},
+            "python": platform.python_version(),
+            "pillow": PIL.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "stages": {},
+        }
+        for stage in args.stages.split(","):
+            gallery = os.path.join(work_dir, stage)
+            shutil.copytree(template, gallery)
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), "--run-stage", stage,
+                                     "--gallery", gallery, "--workers", str(args.workers)],
+                                    stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+            results["stages"][stage] = json.loads(output.strip().split("\n")[-1])  # optimizer prints before
+            print(stage + ": " + str(round(results["stages"][stage]["seconds"], 2)) + "s", file=sys.stderr)
+            shutil.rmtree(gallery)
+            shutil.rmtree(gallery + "_thumb", ignore_errors=True)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
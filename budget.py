@@ -0,0 +1,71 @@
+import os
+
+from PIL import Image
+
+BYTES_PER_PIXEL = 8  # decoded RGBA pixel and a working copy (rotation, conversion, encoder buffers)
+
+
+class PixelBudget:
+    """
+    Admission control of the images decoded at the same time, so workers running in parallel
+    never hold more decoded pixels than the memory budget allows
+    An image is always admitted when nothing else is running, so an image larger than the budget is processed alone
+    """
+    def __init__(self, max_pixels):
+        self.max_pixels = max_pixels
+        self.used = 0
+        self.costs = {}  # {key: pixels} of the admitted images
+
+    def can_admit(self, pixels):
+        """
+        Check if an image can be decoded now
+
+        :param pixels: decoded pixels of the image
+        :return: True if it fits in what is left of the budget, or if nothing else is running
+        """
+        return self.used == 0 or self.used + pixels <= self.max_pixels
+
+    def admit(self, key, pixels):
+        """
+        Count an image being decoded
+
+        :param key: identifies the image until it is released
+        :param pixels: decoded pixels of the image
+        :return:
+        """
+        self.costs[key] = pixels
+        self.used += pixels
+
+    def release(self, key):
+        """
+        Give back the pixels of an image once it is processed, unknown keys are ignored
+
+        :param key: key given to admit
+        :return:
+        """
+        self.used -= self.costs.pop(key, 0)
+
+
+def get_default_memory_budget():
+    """
+    Get the default memory budget: half of the physical memory
+    :return: budget in bytes, None if the physical memory is unknown on this platform
+    """
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 2
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def get_image_pixels(path):
+    """
+    Get the number of pixels of an image from its header, without decoding it
+
+    :param path: image path or file object
+    :return: width * height, 0 if the image cannot be read (the worker reports the error)
+    """
+    try:
+        with Image.open(path) as img:
+            return img.size[0] * img.size[1]
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return 0
@@ -0,0 +1,175 @@
+#!/usr/bin/python3
+import argparse
+import os
+import signal
+import sys
+from functools import partial
+from multiprocessing import freeze_support
+
+from budget import get_default_memory_budget
+from optimizer import ImageOptimizer
+from processing import parse_thumb_specs, MIN_SAVING, PROFILES, DEFAULT_COMPRESS_PROFILE, DEFAULT_THUMB_PROFILE
+from progress import format_progress
+from scanner import Scanner
+from watcher import Watcher, POLL_INTERVAL
+
+EXIT_OK = 0
+EXIT_ERROR = 1
+EXIT_USAGE = 2  # used by argparse
+EXIT_ABORTED = 130
+
+
+def create_parser():
+    """
+    Create the command line arguments parser
+    :return: parser
+    """
+    parser = argparse.ArgumentParser(description="Optimize image galleries for websites, without any UI. "
+                                                 "If no action is given, all of them are done")
+    parser.add_argument("parent_path", help="directory containing the image gallery")
+    parser.add_argument("-t", "--thumb-path", help="directory where thumbnails are saved (default: PARENT_PATH_thumb)")
+    parser.add_argument("-q", "--quality", type=int, default=30, choices=range(10, 101), metavar="[10-100]",
+                        help="quality of the compressed images, highest quality with a target size (default: 30)")
+    parser.add_argument("--target-size", type=int, metavar="KB",
+                        help="compress each image to the highest quality (up to QUALITY) that fits in this size")
+    parser.add_argument("--target-bpp", type=float, metavar="BITS",
+                        help="like --target-size, in bits per pixel of the image")
+    parser.add_argument("--webp", type=int, choices=range(1, 101), metavar="[1-100]",
+                        help="also write a WebP variant of each compressed image (as IMAGE.webp) and JPEG thumbnail, "
+                             "with this quality")
+    parser.add_argument("--min-saving", type=float, default=MIN_SAVING * 100, metavar="PERCENT",
+                        help="leave images untouched when compressing them saves less than this (default: "
+                             + str(round(MIN_SAVING * 100)) + "). JPEGs already at or below QUALITY are never "
+                             "re-encoded")
+    parser.add_argument("-p", "--profile", choices=sorted(PROFILES), default=DEFAULT_COMPRESS_PROFILE,
+                        help="encoding profile of compressed images: web strips EXIF and XMP data and writes "
+                             "progressive JPEGs, archive keeps every metadata (default: "
+                             + DEFAULT_COMPRESS_PROFILE + ")")
+    parser.add_argument("--thumb-profile", choices=sorted(PROFILES), default=DEFAULT_THUMB_PROFILE,
+                        help="encoding profile of thumbnails, thumbnail strips every metadata (default: "
+                             + DEFAULT_THUMB_PROFILE + ")")
+    parser.add_argument("-c", "--compress", action="store_true", help="compress images")
+    parser.add_argument("-z", "--zip", action="store_true", help="create one .zip per directory")
+    parser.add_argument("-m", "--thumb", action="store_true", help="create thumbnails")
+    parser.add_argument("--thumb-specs", type=parse_thumb_specs, metavar="SPECS",
+                        help="comma separated thumbnail sizes, WIDTHxHEIGHT[:crop|fit][:jpeg|png|webp][:quality], "
+                             "all made from one decode (default: 140x105)")
+    parser.add_argument("--sprites", action="store_true",
+                        help="also pack the first thumbnails of each directory into sprite sheets, "
+                             "with a JSON map of where each thumbnail is, in the .sprites sub directory of its "
+                             "thumbnail directory (sprites_N.jpg and sprites.json)")
+    parser.add_argument("-d", "--dedup", action="store_true",
+                        help="compress identical images and make their thumbnails only once, the other copies get "
+                             "hard links to (or copies of) the outputs")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1,
+                        help="number of processes used for compression and thumbnails, and of zips "
+                             "created at the same time (default: CPU count)")
+    parser.add_argument("--memory", type=int, metavar="MB",
+                        help="memory budget of the images decoded at the same time, a larger image is processed "
+                             "alone, 0 for no limit (default: half of the physical memory)")
+    parser.add_argument("-f", "--full", action="store_true",
+                        help="process every image, even those unchanged since the last run, and list every "
+                             "directory instead of reusing the ones unchanged since the last scan, so images "
+                             "rewritten in place are seen")
+    parser.add_argument("--watch", type=float, nargs="?", const=POLL_INTERVAL, metavar="SECONDS",
+                        help="after the first run, keep watching the gallery and optimize images as they are added or "
+                             "changed, until interrupted. Changes are notified if watchdog is installed, the gallery "
+                             "is checked every SECONDS otherwise (default: " + str(POLL_INTERVAL) + ")")
+    parser.add_argument("--hash", action="store_true",
+                        help="also identify images by a hash of their content, so images only touched or copied "
+                             "since the last run are skipped, at the cost of reading them")
+    parser.add_argument("-r", "--report", help="JSON file the run report (timings, sizes, failures) is written to")
+    parser.add_argument("-s", "--stats", action="store_true", help="print live stats every second")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print the progress of each action")
+    return parser
+
+
+def main(argv=None):
+    """
+    Scan the parent directory and optimize the images found
+    :param argv: command line arguments, sys.argv by default
+    :return: exit code
+    """
+    args = create_parser().parse_args(argv)
+    # Absolute like the paths the UI gives, so "." or ".." are not taken for hidden directories
+    parent_path = os.path.abspath(args.parent_path)
+    if not os.path.isdir(parent_path):
+        print("Error: '" + parent_path + "' is not a directory", file=sys.stderr)
+        return EXIT_ERROR
+    thumb_path = os.path.abspath(args.thumb_path) if args.thumb_path else parent_path + "_thumb"
+    is_all = not (args.compress or args.zip or args.thumb)
+
+    scanner = Scanner(parent_path, use_index=not args.full)
+    scan_result = []
+    scanner.signals.scan_finished_signal.connect(scan_result.append)
+    if args.verbose:
+        scanner.signals.progress_signal.connect(print_progress)
+    signal.signal(signal.SIGINT, lambda signum, frame: scanner.stop())
+    scanner.run()
+    if scanner.is_aborted():
+        return EXIT_ABORTED
+    scan_result = scan_result[0]
+    print(str(scan_result.image_count) + " images found in " + str(len(scan_result.images)) + " directories")
+
+    def make_optimizer(dir_list, image_list, images, is_full=args.full):
+        optimizer = ImageOptimizer(dir_list, image_list, parent_path, thumb_path, is_all or args.compress,
+                                   is_all or args.zip, is_all or args.thumb, args.quality, max(1, args.workers),
+                                   not is_full, images=images, stats_hook=print_stats if args.stats else None,
+                                   report_path=args.report,
+                                   target_size=args.target_size * 1000 if args.target_size else None,
+                                   target_bpp=args.target_bpp, thumb_specs=args.thumb_specs,
+                                   webp_quality=args.webp, min_saving=args.min_saving / 100,
+                                   compress_profile=args.profile, thumb_profile=args.thumb_profile,
+                                   memory_budget=args.memory * 1000000 if args.memory is not None
+                                   else get_default_memory_budget(),
+                                   is_dedup=args.dedup, is_sprite=args.sprites, use_hash=args.hash)
+        if args.verbose:
+            optimizer.signals.progress_signal.connect(print_progress)
+        return optimizer
+
+    optimizer = make_optimizer(scan_result.get_dir_list(), scan_result.image_list, scan_result.images)
+    signal.signal(signal.SIGINT, lambda signum, frame: optimizer.stop())
+    optimizer.run()
+    if optimizer.is_aborted():
+        return EXIT_ABORTED
+    if args.watch is not None:
+        # Images already processed are skipped with the manifest, even after a full run
+        watcher = Watcher(parent_path, optimizer.images, partial(make_optimizer, is_full=False), thumb_path,
+                          interval=args.watch)
+        signal.signal(signal.SIGINT, lambda signum, frame: watcher.stop())
+        watcher.run()
+        return EXIT_OK
+    return EXIT_ERROR if len(optimizer.report["failures"]) > 0 else EXIT_OK
+
+
+def print_progress(action, done, total, rate, remaining, task):
+    """
+    Print the progress of an action, see Progress
+
+    :param action: scan, compress, zip, thumb or sprite
+    :param done: items processed
+    :param total: items to process, 0 if unknown
+    :param rate: items per second
+    :param remaining: seconds left, negative if unknown
+    :param task: what is being processed
+    :return:
+    """
+    print(action + ": " + task + " (" + format_progress(done, total, rate, remaining) + ")")
+
+
+def print_stats(report):
+    """
+    Print a one line summary of a run report
+
+    :param report: RunStats report
+    :return:
+    """
+    counts = ", ".join(action + ": " + str(values["processed"]) + " done " + str(values["skipped"]) + " skipped "
+                       + str(values["failed"]) + " failed" for action, values in report["counts"].items())
+    print("[" + str(round(report["seconds"], 1)) + "s] " + counts + " - "
+          + str(round(report["images_per_sec"] or 0, 1)) + " images/s", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    freeze_support()
+    sys.exit(main())
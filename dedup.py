@@ -0,0 +1,58 @@
+import os
+import shutil
+
+from manifest import get_file_hash
+from utils import get_temp_path
+
+
+def find_duplicates(image_list, get_stat):
+    """
+    Find the images with the same content: images are first grouped by size, and only images sharing their size
+    with another one are hashed
+
+    :param image_list: image paths, in processing order
+    :param get_stat: function giving the ImageStat of an image
+    :return: {duplicate path: path of the first image with the same content}
+    """
+    sizes = {}  # {size: [image paths]}
+    for path in image_list:
+        sizes.setdefault(get_stat(path).size, []).append(path)
+    duplicates = {}
+    for paths in sizes.values():
+        if len(paths) < 2:
+            continue
+        originals = {}  # {hash: first image with this content}
+        for path in paths:
+            try:
+                content_hash = get_file_hash(path)
+            except OSError:
+                continue  # processed on its own, the error is reported then
+            original = originals.setdefault(content_hash, path)
+            if original != path:
+                duplicates[path] = original
+    return duplicates
+
+
+def link_or_copy(source, destination):
+    """
+    Replace a file by a hard link to an other one, or by a copy if hard links are not supported
+    The file is replaced atomically, like the other outputs
+
+    :param source: existing file
+    :param destination: file to create or replace
+    :return:
+    """
+    os.makedirs(os.path.dirname(destination) or ".", exist_ok=True)
+    temp_path = get_temp_path(destination)
+    if os.path.lexists(temp_path):
+        os.remove(temp_path)  # left by an interrupted job
+    try:
+        os.link(source, temp_path)
+    except OSError:  # other file system, or no hard link support
+        try:
+            shutil.copy2(source, temp_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+    os.replace(temp_path, destination)
@@ -0,0 +1,69 @@
+from PyQt5.QtCore import QAbstractListModel, QModelIndex, Qt
+
+
+class DirectoryListModel(QAbstractListModel):
+    """
+    Directories shown in the UI list, stored as a plain list of paths
+    The view only asks for the rows it displays, so the list stays fast with hundreds of thousands of directories
+    """
+    def __init__(self, parent=None):
+        super(DirectoryListModel, self).__init__(parent)
+        self.dirs = []
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.dirs)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and index.isValid():
+            return self.dirs[index.row()]
+        return None
+
+    def add_dirs(self, dirs):
+        """
+        Append directories at the end of the list, in one insertion
+
+        :param dirs: list of directories paths
+        :return:
+        """
+        if len(dirs) == 0:
+            return
+        self.beginInsertRows(QModelIndex(), len(self.dirs), len(self.dirs) + len(dirs) - 1)
+        self.dirs.extend(dirs)
+        self.endInsertRows()
+
+    def remove_rows(self, rows):
+        """
+        Remove directories, each run of consecutive rows in one removal
+
+        :param rows: rows to remove, in any order
+        :return: list of the directories removed
+        """
+        removed = []
+        rows = sorted(set(rows), reverse=True)
+        i = 0
+        while i < len(rows):
+            last = first = rows[i]
+            i += 1
+            while i < len(rows) and rows[i] == first - 1:
+                first = rows[i]
+                i += 1
+            self.beginRemoveRows(QModelIndex(), first, last)
+            removed += self.dirs[first:last + 1]
+            del self.dirs[first:last + 1]
+            self.endRemoveRows()
+        return removed
+
+    def clear(self):
+        """
+        Remove every directory
+        :return:
+        """
+        self.beginResetModel()
+        self.dirs = []
+        self.endResetModel()
+
+    def get_dir_list(self):
+        """
+        :return: list of the directories, in the order of the list
+        """
+        return list(self.dirs)
@@ -0,0 +1,42 @@
+class Event:
+    """
+    Plain list of callbacks with the same connect/emit interface as a pyqtSignal, usable without Qt
+    """
+    def __init__(self):
+        self.callbacks = []
+
+    def connect(self, callback):
+        """
+        Call the given function each time the event is emitted
+        :param callback: function to call with the emitted values
+        :return:
+        """
+        self.callbacks.append(callback)
+
+    def emit(self, *args):
+        """
+        Call every connected function
+        :param args: values given to the functions
+        :return:
+        """
+        for callback in self.callbacks:
+            callback(*args)
+
+
+class OptimizerEvents:
+    """
+    Optimizer callbacks, mirroring the Qt OptimizerSignals
+    """
+    def __init__(self):
+        self.finished_signal = Event()  # optimizer has finished
+        self.progress_signal = Event()  # (action, done, total, items/s, seconds left, current task), a few per second
+
+
+class ScannerEvents:
+    """
+    Scanner callbacks, mirroring the Qt ScannerSignals
+    """
+    def __init__(self):
+        self.scan_finished_signal = Event()  # scan has finished, with the ScanResult
+        self.scanned_dir_signal = Event()  # list of directories found since the last event
+        self.progress_signal = Event()  # (action, done, total, items/s, seconds left, current task), a few per second
@@ -1,16 +1,23 @@
 #!/usr/bin/python3
 import os
 import sys
+from multiprocessing import freeze_support
 
 from PyQt5.QtCore import QThreadPool, Qt, pyqtSlot
 from PyQt5.QtGui import QIcon
-from PyQt5.QtWidgets import QMainWindow, QAction, QDesktopWidget, QWidget, QFrame, QLineEdit, QListWidget, QVBoxLayout, \
+from PyQt5.QtWidgets import QMainWindow, QAction, QDesktopWidget, QWidget, QFrame, QLineEdit, QListView, QVBoxLayout, \
     QLabel, QPushButton, QGridLayout, QMessageBox, QDialog, QTabWidget, QApplication, QCheckBox, \
-    QProgressBar, QGroupBox, QDoubleSpinBox
+    QProgressBar, QGroupBox, QDoubleSpinBox, QSpinBox, QFileDialog
 
+from budget import get_default_memory_budget
+from directory_model import DirectoryListModel
 from optimizer import ImageOptimizer
+from processing import parse_thumb_specs, format_thumb_specs, DEFAULT_THUMB_SPEC
+from progress import format_progress
+from scan_result import ScanResult
 from scanner import Scanner
-from utils import create_file_dialog, remove_images_from_folders, resource_path
+from utils import resource_path
+from workers import OptimizerSignals, ScannerSignals, Worker
 
 
 # TODO:
@@ -103,7 +110,8 @@ class MainWidgets(QWidget):
         self.scan_progress_bar = QProgressBar()
         self.scan_progress_text = QLabel("Scan")
         self.dir_list_group = QFrame()
-        self.directories_list = QListWidget()
+        self.directories_model = DirectoryListModel()
+        self.directories_list = QListView()
         self.scan_button = QPushButton("Scanner")
         self.stop_scan_button = QPushButton("Stop")
         self.optimize_button = QPushButton("Optimiser")
@@ -113,18 +121,28 @@ class MainWidgets(QWidget):
         self.compress_group = QGroupBox()
         self.compress_quality_label = QLabel("Qualité :")
         self.compress_quality_edit = QDoubleSpinBox()
+        self.compress_target_label = QLabel("Taille cible :")
+        self.compress_target_edit = QSpinBox()
+        self.compress_webp_label = QLabel("WebP :")
+        self.compress_webp_edit = QSpinBox()
         self.enable_compress_radio_button = QCheckBox("Compresser photos")
         self.zip_group = QGroupBox()
         self.enable_zip_radio_button = QCheckBox("Créer .zip")
         self.thumb_group = QGroupBox()
         self.enable_thumb_radio_button = QCheckBox("Créer miniatures")
+        self.thumb_specs_label = QLabel("Tailles :")
+        self.thumb_specs_edit = QLineEdit(format_thumb_specs([DEFAULT_THUMB_SPEC]))
+        self.workers_group = QGroupBox()
+        self.workers_label = QLabel("Processus :")
+        self.workers_edit = QSpinBox()
+        self.enable_incremental_radio_button = QCheckBox("Ignorer inchangés")
         self.compress_progress_bar = QProgressBar()
         self.compress_progress_text = QLabel("Compression")
         self.zip_progress_bar = QProgressBar()
         self.zip_progress_text = QLabel("Création de .zip")
         self.thumb_progress_bar = QProgressBar()
         self.thumb_progress_text = QLabel("Création de miniatures")
-        self.image_list = []
+        self.scan_result = ScanResult()  # images of the last scan, without the directories removed from the list
         self.main_layout = QGridLayout()
         self.scanner = Scanner("")
         self.compresser = ImageOptimizer([], [], "", "", True, True, True, 30)
@@ -196,6 +214,11 @@ class MainWidgets(QWidget):
 
         y += 1
         self.directories_list.setToolTip("Liste des dossiers contenant des images, trouvés dans le dossier parent")
+        self.directories_list.setModel(self.directories_model)
+        # Every row has the same height, so the view only lays out the visible rows
+        self.directories_list.setUniformItemSizes(True)
+        self.directories_list.setLayoutMode(QListView.Batched)
+        self.directories_list.setSelectionMode(QListView.ExtendedSelection)
         self.main_layout.addWidget(self.directories_list, y, 0, 10, 19)
         self.delete_button.clicked.connect(self.dir_list_delete_selected)
         self.delete_button.setIcon(QIcon(resource_path("icons/icons8-effacer-96.png")))
@@ -220,6 +243,23 @@ class MainWidgets(QWidget):
                                               "plus l'image finale sera de bonne qualité\n30 permet de réduire la "
                                               "taille de l'image d'un facteur proche de 10")
         compress_layout.addWidget(self.compress_quality_edit, 1, 1, 1, 1)
+        compress_layout.addWidget(self.compress_target_label, 2, 0, 1, 1)
+        self.compress_target_edit.setMaximum(100000)
+        self.compress_target_edit.setSingleStep(50)
+        self.compress_target_edit.setSuffix(" Ko")
+        self.compress_target_edit.setSpecialValueText("Aucune")  # 0: the quality is used as is
+        self.compress_target_edit.setToolTip("Taille maximale de chaque image compressée. La meilleure qualité, "
+                                             "jusqu'à la qualité ci-dessus, qui respecte cette taille est utilisée"
+                                             "\nAucune pour utiliser la qualité ci-dessus pour toutes les images")
+        compress_layout.addWidget(self.compress_target_edit, 2, 1, 1, 1)
+        compress_layout.addWidget(self.compress_webp_label, 3, 0, 1, 1)
+        self.compress_webp_edit.setMaximum(100)
+        self.compress_webp_edit.setSingleStep(10)
+        self.compress_webp_edit.setSpecialValueText("Non")  # 0: no WebP variant
+        self.compress_webp_edit.setToolTip("Qualité des copies WebP, plus légères, écrites à côté de chaque image "
+                                           "compressée (image.jpg.webp) et de chaque miniature JPEG\nNon pour ne "
+                                           "pas créer de copies WebP")
+        compress_layout.addWidget(self.compress_webp_edit, 3, 1, 1, 1)
         self.main_layout.addWidget(self.compress_group, y, 19, 1, 1)
 
         y += 1
@@ -238,12 +278,38 @@ class MainWidgets(QWidget):
         self.enable_thumb_radio_button.setChecked(True)
         self.enable_thumb_radio_button.setToolTip("Créer une miniature pour chaque image, sauvegardée dans le dossier "
                                                   "de miniatures ci-dessus\nLa structure des dossiers interne est "
-                                                  "respectée, et les miniatures sont en 140x105 (format 4*3)")
-        thumb_layout.addWidget(self.enable_thumb_radio_button, y, 19, 1, 1)
+                                                  "respectée, et les miniatures sont en 140x105 (format 4*3) par "
+                                                  "défaut")
+        thumb_layout.addWidget(self.enable_thumb_radio_button, 0, 0, 1, 2)
+        thumb_layout.addWidget(self.thumb_specs_label, 1, 0, 1, 1)
+        self.thumb_specs_edit.setToolTip("Tailles des miniatures, séparées par des virgules, toutes créées en une "
+                                         "seule lecture de l'image\nLARGEURxHAUTEUR[:crop|fit][:jpeg|png|webp]"
+                                         "[:qualité], par exemple 140x105,800x600:fit:webp:80\nLa première est "
+                                         "nommée comme l'image, les suivantes ont le suffixe _LARGEURxHAUTEUR")
+        thumb_layout.addWidget(self.thumb_specs_edit, 1, 1, 1, 1)
         self.thumb_group.setLayout(thumb_layout)
         self.main_layout.addWidget(self.thumb_group, y, 19, 1, 1)
 
-        y += 7
+        y += 1
+        workers_layout = QGridLayout()
+        workers_layout.addWidget(self.workers_label, 0, 0, 1, 1)
+        self.workers_edit.setMinimum(1)
+        self.workers_edit.setMaximum(max(os.cpu_count() or 1, 64))
+        self.workers_edit.setValue(os.cpu_count() or 1)
+        self.workers_edit.setToolTip("Nombre de processus utilisés en parallèle pour la compression et les "
+                                     "miniatures, et de .zip créés en même temps\n1 pour tout traiter dans un "
+                                     "seul processus")
+        workers_layout.addWidget(self.workers_edit, 0, 1, 1, 1)
+        self.enable_incremental_radio_button.setChecked(True)
+        self.enable_incremental_radio_button.setToolTip("Ne traiter que les images et dossiers nouveaux ou modifiés "
+                                                        "depuis la dernière optimisation, et ne relister que les "
+                                                        "dossiers modifiés depuis le dernier scan\nDécocher pour voir "
+                                                        "aussi les images réécrites sans changer de nom")
+        workers_layout.addWidget(self.enable_incremental_radio_button, 1, 0, 1, 2)
+        self.workers_group.setLayout(workers_layout)
+        self.main_layout.addWidget(self.workers_group, y, 19, 1, 1)
+
+        y += 6
         self.optimize_button.clicked.connect(self.optimize_click)
         self.optimize_button.setIcon(QIcon(resource_path("icons/icons8-compresse-96.png")))
         self.optimize_button.setToolTip("Optimiser les images contenues dans les dossiers ci-dessus en utilisant les paramètres sélectionnés")
@@ -287,15 +353,15 @@ class MainWidgets(QWidget):
         :return:
         """
         self.list_title.setText(
-            str(len(self.image_list)) + " images dans " + str(len(self.get_dir_list())) + " dossiers :")
+            str(self.scan_result.image_count) + " images dans " + str(len(self.scan_result.images)) + " dossiers :")
 
     def update_parent_dir(self):
         """
         Reset UI when updating the parent directory
         :return:
         """
-        self.directories_list.clear()
-        self.image_list = []
+        self.directories_model.clear()
+        self.scan_result = ScanResult()
         self.update_scan_result_text()
         self.reset_progress_scan()
         self.reset_progress_compress()
@@ -307,20 +373,17 @@ class MainWidgets(QWidget):
         Remove the selected directory from the list, and all its images
         :return:
         """
-        for selected_item in self.directories_list.selectedItems():
-            self.image_list = remove_images_from_folders(selected_item.text(), self.image_list)
-            self.directories_list.takeItem(self.directories_list.row(selected_item))
-            self.update_scan_result_text()
+        rows = [index.row() for index in self.directories_list.selectionModel().selectedIndexes()]
+        for path in self.directories_model.remove_rows(rows):
+            self.scan_result.remove_dir(path)
+        self.update_scan_result_text()
 
     def get_dir_list(self):
         """
-        Get the directories list from the UI
+        Get the directories list, in the order of the UI
         :return:
         """
-        items = []
-        for index in range(self.directories_list.count()):
-            items.append(self.directories_list.item(index).text())
-        return items
+        return self.directories_model.get_dir_list()
 
     def set_compress_enabled(self, enabled):
         """
@@ -332,6 +395,10 @@ class MainWidgets(QWidget):
         self.compress_progress_text.setEnabled(enabled)
         self.compress_quality_label.setEnabled(enabled)
         self.compress_quality_edit.setEnabled(enabled)
+        self.compress_target_label.setEnabled(enabled)
+        self.compress_target_edit.setEnabled(enabled)
+        self.compress_webp_label.setEnabled(enabled)
+        self.compress_webp_edit.setEnabled(enabled)
 
     def set_zip_enabled(self, enabled):
         """
@@ -351,6 +418,8 @@ class MainWidgets(QWidget):
         self.thumb_progress_bar.setHidden(not enabled)
         self.thumb_progress_text.setEnabled(enabled)
         self.dir_thumb_path_group.setEnabled(enabled)
+        self.thumb_specs_label.setEnabled(enabled)
+        self.thumb_specs_edit.setEnabled(enabled)
 
     def set_ui_enabled(self, enabled, is_scan):
         """
@@ -373,6 +442,7 @@ class MainWidgets(QWidget):
         self.zip_group.setEnabled(enabled)
         self.compress_group.setEnabled(enabled)
         self.thumb_group.setEnabled(enabled)
+        self.workers_group.setEnabled(enabled)
         self.dir_selection_button.setEnabled(enabled)
         self.dir_thumb_selection_button.setEnabled(enabled)
         self.stop_scan_button.setEnabled((not enabled) and is_scan)
@@ -383,16 +453,15 @@ class MainWidgets(QWidget):
         Start the scan in an other thread and disable the UI
         :return:
         """
-        self.directories_list.clear()
+        self.directories_model.clear()
         self.set_ui_enabled(False, True)
         # Start scan thread
-        self.scanner = Scanner(self.dir_path_line_edit.text())
-        self.scanner.signals.scanned_dir_signal.connect(self.add_dir_to_list)
+        self.scanner = Scanner(self.dir_path_line_edit.text(), ScannerSignals(),
+                               use_index=self.enable_incremental_radio_button.isChecked())
+        self.scanner.signals.scanned_dir_signal.connect(self.add_dirs_to_list)
         self.scanner.signals.scan_finished_signal.connect(self.scan_finished)
-        self.scanner.signals.scanned_dir_finished.connect(self.reset_progress_scan)
-        self.scanner.signals.scanned_images_signal.connect(self.add_progress_scan)
-        self.scanner.signals.new_scan_task_started.connect(self.scan_progress_text.setText)
-        self.thread_pool.start(self.scanner)
+        self.scanner.signals.progress_signal.connect(self.update_progress)
+        self.thread_pool.start(Worker(self.scanner))
 
     def stop_scan(self):
         """
@@ -401,49 +470,71 @@ class MainWidgets(QWidget):
         """
         self.scanner.stop()
 
-    def add_dir_to_list(self, directory):
+    def add_dirs_to_list(self, directories):
         """
-        Add given directory to the UI list
-        :param directory: dir to add to the list
+        Add given directories to the UI list
+        :param directories: dirs to add to the list
         :return:
         """
-        self.directories_list.addItem(directory)
+        self.directories_model.add_dirs(directories)
 
-    def scan_finished(self, dir_list, image_list):
+    def scan_finished(self, scan_result):
         """
         Re-enabled the UI and reset progress bars
         Display a recap window of directories and images found, and whether the scan finished properly or was canceled
-        :param dir_list: list of directories found
-        :param image_list: list of images found
+        :param scan_result: ScanResult of the images found
         :return:
         """
         self.set_ui_enabled(True, True)
-        self.image_list = image_list
+        self.scan_result = scan_result
         self.update_scan_result_text()
+        self.scan_progress_bar.setMaximum(max(1, len(scan_result.images)))
+        self.scan_progress_bar.setValue(self.scan_progress_bar.maximum())
         self.reset_progress_compress()
         self.reset_progress_zip()
         self.reset_progress_thumb()
         if self.scanner.is_aborted():
-            QMessageBox.warning(self, "Scan Annulé", "Scan des dossiers stoppé\n" + str(len(dir_list)) + " dossier et "
-                                + str(len(self.image_list)) + " images trouvés")
+            QMessageBox.warning(self, "Scan Annulé", "Scan des dossiers stoppé\n" + str(len(scan_result.images))
+                                + " dossier et " + str(scan_result.image_count) + " images trouvés")
         else:
             QMessageBox.information(self, "Scan Terminé",
-                                    "Scan des dossiers terminé\n" + str(len(dir_list)) + " dossier et "
-                                    + str(len(self.image_list)) + " images trouvés")
+                                    "Scan des dossiers terminé\n" + str(len(scan_result.images)) + " dossier et "
+                                    + str(scan_result.image_count) + " images trouvés")
 
     def optimize_click(self):
         """
         Display a confirmation window or an eror window if no actions were selected
         :return:
         """
-        if self.directories_list.count() == 0:
+        if self.directories_model.rowCount() == 0:
             QMessageBox.warning(self, "Erreur", "Aucun dossier trouvé\nVeuillez vérifier le dossier parent")
         elif (not self.enable_compress_radio_button.checkState()) and (not self.enable_zip_radio_button.checkState()) \
                 and (not self.enable_thumb_radio_button.checkState()):
             QMessageBox.warning(self, "Erreur", "Aucune action sélectionnée")
+        elif self.enable_thumb_radio_button.checkState() and self.get_thumb_specs() is None:
+            QMessageBox.warning(self, "Erreur", "Tailles de miniatures invalides\nExemple : 140x105,800x600:fit")
         else:
             self.show_confirmation_dialog()
 
+    def get_thumb_specs(self):
+        """
+        Get the thumbnail specs from the UI
+        :return: list of ThumbSpec, None if they are not valid
+        """
+        try:
+            return parse_thumb_specs(self.thumb_specs_edit.text())
+        except ValueError:
+            return None
+
+    def get_webp_quality(self):
+        """
+        Get the quality of the WebP copies from the UI, its field belongs to the compression settings
+        :return: quality, None if compression is disabled or no WebP copies are wanted
+        """
+        if not self.enable_compress_radio_button.checkState():
+            return None
+        return self.compress_webp_edit.value() or None
+
     def show_confirmation_dialog(self):
         """
         Display a confirmation window showing a recap of what action the app is about to perform
@@ -451,14 +542,19 @@ class MainWidgets(QWidget):
         If yes, start the optimisation thread and disable the UI
         :return:
         """
-        msg = str(len(self.get_dir_list())) + " dossiers contenant " + str(len(self.image_list)) + \
+        msg = str(len(self.scan_result.images)) + " dossiers contenant " + str(self.scan_result.image_count) + \
               " images selectionnés\n\nActions à réaliser :"
         if self.enable_compress_radio_button.checkState():
-            msg += "\nCompression des images (Qualité : " + str(int(self.compress_quality_edit.value())) + ")"
+            msg += "\nCompression des images (Qualité : " + str(int(self.compress_quality_edit.value()))
+            if self.compress_target_edit.value() > 0:
+                msg += " maximum, taille cible : " + str(self.compress_target_edit.value()) + " Ko"
+            msg += ")"
+            if self.get_webp_quality() is not None:
+                msg += "\nCréation de copies WebP (Qualité : " + str(self.get_webp_quality()) + ")"
         if self.enable_zip_radio_button.checkState():
             msg += "\nCréation de .zip"
         if self.enable_thumb_radio_button.checkState():
-            msg += "\nCréation de miniatures"
+            msg += "\nCréation de miniatures (" + format_thumb_specs(self.get_thumb_specs()) + ")"
         msg += "\n\nÊtes-vous sûr de vouloir continuer ?"
         confirmation_dialog = QMessageBox.question(self, 'Confirmation', msg,
                                                    QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
@@ -468,20 +564,23 @@ class MainWidgets(QWidget):
             self.reset_progress_zip()
             self.reset_progress_thumb()
             self.set_ui_enabled(False, False)
-            self.compresser = ImageOptimizer(self.get_dir_list(), self.image_list, self.dir_path_line_edit.text(),
+            self.compresser = ImageOptimizer(self.get_dir_list(), self.scan_result.image_list,
+                                             self.dir_path_line_edit.text(),
                                              self.dir_thumb_path_line_edit.text(),
                                              self.enable_compress_radio_button.checkState(),
                                              self.enable_zip_radio_button.checkState(),
                                              self.enable_thumb_radio_button.checkState(),
-                                             self.compress_quality_edit.value())
+                                             self.compress_quality_edit.value(),
+                                             self.workers_edit.value(),
+                                             self.enable_incremental_radio_button.checkState(),
+                                             OptimizerSignals(), self.scan_result.images,
+                                             target_size=self.compress_target_edit.value() * 1000 or None,
+                                             thumb_specs=self.get_thumb_specs(),
+                                             webp_quality=self.get_webp_quality(),
+                                             memory_budget=get_default_memory_budget())
             self.compresser.signals.finished_signal.connect(self.opimize_finished)
-            self.compresser.signals.new_compress_task_started.connect(self.compress_progress_text.setText)
-            self.compresser.signals.new_zip_task_started.connect(self.zip_progress_text.setText)
-            self.compresser.signals.new_thumb_task_started.connect(self.thumb_progress_text.setText)
-            self.compresser.signals.compress_done.connect(self.add_progress_compress)
-            self.compresser.signals.zip_done.connect(self.add_progress_zip)
-            self.compresser.signals.thumb_done.connect(self.add_progress_thumb)
-            self.thread_pool.start(self.compresser)
+            self.compresser.signals.progress_signal.connect(self.update_progress)
+            self.thread_pool.start(Worker(self.compresser))
 
     def stop_optimize(self):
         """
@@ -512,8 +611,8 @@ class MainWidgets(QWidget):
         """
         self.compress_progress_text.setText("Compression")
         self.compress_progress_bar.setMinimum(0)
-        if len(self.image_list) != 0:
-            self.compress_progress_bar.setMaximum(len(self.image_list))
+        if self.scan_result.image_count != 0:
+            self.compress_progress_bar.setMaximum(self.scan_result.image_count)
         else:
             self.compress_progress_bar.setMaximum(100)
         self.compress_progress_bar.setValue(0)
@@ -540,39 +639,33 @@ class MainWidgets(QWidget):
         """
         self.thumb_progress_text.setText("Création de miniatures")
         self.thumb_progress_bar.setMinimum(0)
-        if len(self.image_list) != 0:
-            self.thumb_progress_bar.setMaximum(len(self.image_list))
+        if self.scan_result.image_count != 0:
+            self.thumb_progress_bar.setMaximum(self.scan_result.image_count)
         else:
             self.thumb_progress_bar.setMaximum(100)
         self.thumb_progress_bar.setValue(0)
 
-    def add_progress_scan(self):
-        """
-        increment the scan progress bar by one
-        :return:
-        """
-        self.scan_progress_bar.setValue(self.scan_progress_bar.value() + 1)
-
-    def add_progress_compress(self):
+    def update_progress(self, action, done, total, rate, remaining, task):
         """
-        increment the compress progress bar by one
+        Update the progress bar and text of an action, called a few times per second by the running task
+        :param action: scan, compress, zip, thumb or sprite
+        :param done: items processed
+        :param total: items to process, 0 if unknown: the progress bar shows a busy indicator
+        :param rate: items per second
+        :param remaining: seconds left, negative if unknown
+        :param task: what is being processed
         :return:
         """
-        self.compress_progress_bar.setValue(self.compress_progress_bar.value() + 1)
-
-    def add_progress_zip(self):
-        """
-        increment the zip progress bar by one
-        :return:
-        """
-        self.zip_progress_bar.setValue(self.zip_progress_bar.value() + 1)
-
-    def add_progress_thumb(self):
-        """
-        increment the thumb progress bar by one
-        :return:
-        """
-        self.thumb_progress_bar.setValue(self.thumb_progress_bar.value() + 1)
+        progress_bar, progress_text = {
+            "scan": (self.scan_progress_bar, self.scan_progress_text),
+            "compress": (self.compress_progress_bar, self.compress_progress_text),
+            "zip": (self.zip_progress_bar, self.zip_progress_text),
+            "thumb": (self.thumb_progress_bar, self.thumb_progress_text),
+            "sprite": (self.thumb_progress_bar, self.thumb_progress_text),
+        }[action]
+        progress_bar.setMaximum(total)
+        progress_bar.setValue(done)
+        progress_text.setText(task + " (" + format_progress(done, total, rate, remaining) + ")")
 
     def opimize_finished(self):
         """
@@ -607,6 +700,20 @@ class MainWidgets(QWidget):
             self.dir_thumb_path_line_edit.setText(dialog.selectedFiles()[0])
 
 
+def create_file_dialog():
+    """
+    Create a file dialog object, ready to use
+    :return:
+    """
+    dialog = QFileDialog()
+    dialog.setFileMode(QFileDialog.DirectoryOnly)
+    options = QFileDialog.Options()
+    options |= QFileDialog.DontUseNativeDialog
+    options |= QFileDialog.ShowDirsOnly
+    dialog.setOptions(options)
+    return dialog
+
+
 class HelpDialog(QDialog):
     """
     help window showing information about thee app
@@ -674,6 +781,7 @@ class HelpDialog(QDialog):
 
 
 if __name__ == '__main__':
+    freeze_support()  # worker processes of the frozen executable
     app = QApplication(sys.argv)
     main_window = MainWindow()
     main_window.show()
@@ -0,0 +1,59 @@
+import os
+
+JOURNAL_NAME = ".gallery_optimizer.journal"  # stored in the parent directory
+
+
+class Journal:
+    """
+    Append-only record of the tasks finished by the current job, so a crashed or stopped job can resume
+    from the first unfinished task instead of starting over
+    The journal is removed once the job finishes, and ignored if the next job uses different settings
+    """
+    def __init__(self, parent_path, settings):
+        self.path = os.path.join(parent_path, JOURNAL_NAME)
+        self.done = set()
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as file:
+                lines = file.read().split("\n")
+            # The last line is either empty or was being written when the job stopped
+            if lines[0] == settings:
+                self.done = set(lines[1:-1])
+        if len(self.done) > 0:
+            print("Resuming the previous job, " + str(len(self.done)) + " tasks already done")
+            self.file = open(self.path, "a", encoding="utf-8")
+        else:
+            self.file = open(self.path, "w", encoding="utf-8")
+            self.file.write(settings + "\n")
+            self.file.flush()
+
+    def is_done(self, action, path):
+        """
+        Check if a task was finished by a previous run of the same job
+
+        :param action: name of the action (compress, thumb, zip)
+        :param path: file or directory the action is done on
+        :return: True if the task can be skipped, False otherwise
+        """
+        return action + "\t" + path in self.done
+
+    def add(self, action, path):
+        """
+        Remember that a task is finished
+
+        :param action: name of the action (compress, thumb, zip)
+        :param path: file or directory the action was done on
+        :return:
+        """
+        self.file.write(action + "\t" + path + "\n")
+        self.file.flush()
+
+    def close(self, is_finished):
+        """
+        Close the journal, removing it if the job is finished
+
+        :param is_finished: whether every task of the job was done
+        :return:
+        """
+        self.file.close()
+        if is_finished:
+            os.remove(self.path)
@@ -0,0 +1,114 @@
+import hashlib
+import os
+import sqlite3
+
+MANIFEST_NAME = ".gallery_optimizer.sqlite"  # stored in the parent directory
+COMMIT_INTERVAL = 100  # records written between two commits
+
+
+class Manifest:
+    """
+    Persistent record of the outputs already produced, so unchanged images are skipped on the next run
+    Files are identified by their size and modification time, and optionally by their content hash
+    Directories are identified by the names, sizes and modification times of the images they contain
+    Signatures come from the scan, so checking the manifest does not touch the file system
+    """
+    def __init__(self, parent_path, use_hash=False):
+        self.path = os.path.join(parent_path, MANIFEST_NAME)
+        self.use_hash = use_hash
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS outputs (path TEXT, action TEXT, size INTEGER, "
+                                "mtime INTEGER, hash TEXT, settings TEXT, PRIMARY KEY (path, action))")
+        self.uncommitted = 0
+
+    def close(self):
+        """
+        Write pending records and close the manifest
+        :return:
+        """
+        self.connection.commit()
+        self.connection.close()
+
+    def is_up_to_date(self, path, action, settings, signature, output=None):
+        """
+        Check if the given action was already done on this file or directory with the same settings
+
+        :param path: file or directory the action is done on
+        :param action: name of the action (compress, thumb, zip)
+        :param settings: string describing the settings used by the action
+        :param signature: current ImageStat of the file, or get_dir_signature of the directory
+        :param output: file created by the action, which must still exist
+        :return: True if the action can be skipped, False otherwise
+        """
+        row = self.connection.execute("SELECT size, mtime, hash, settings FROM outputs WHERE path = ? AND action = ?",
+                                      (path, action)).fetchone()
+        if row is None or row[3] != settings or (output is not None and not os.path.exists(output)):
+            return False
+        if len(signature) == 3:  # directory
+            return tuple(signature) == row[:3]
+        if tuple(signature) == row[:2]:
+            return True
+        if self.use_hash and signature[0] == row[0] and row[2] is not None and row[2] == get_file_hash(path):
+            # Same content with a new modification time (copied or touched file)
+            self.connection.execute("UPDATE outputs SET mtime = ? WHERE path = ? AND action = ?",
+                                    (signature[1], path, action))
+            self.count_record()
+            return True
+        return False
+
+    def record(self, path, action, settings, signature):
+        """
+        Remember that the given action was done on this file or directory
+
+        :param path: file or directory the action was done on
+        :param action: name of the action (compress, thumb, zip)
+        :param settings: string describing the settings used by the action
+        :param signature: ImageStat of the file after the action, or get_dir_signature of the directory
+        :return:
+        """
+        if len(signature) == 3:  # directory
+            size, mtime, content_hash = signature
+        else:
+            size, mtime = signature
+            content_hash = get_file_hash(path) if self.use_hash else None
+        self.connection.execute("INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?, ?)",
+                                (path, action, size, mtime, content_hash, settings))
+        self.count_record()
+
+    def count_record(self):
+        """
+        Commit records from time to time, so an interrupted run keeps most of its progress
+        :return:
+        """
+        self.uncommitted += 1
+        if self.uncommitted >= COMMIT_INTERVAL:
+            self.connection.commit()
+            self.uncommitted = 0
+
+
+def get_dir_signature(files):
+    """
+    Get what identifies the current content of a directory
+
+    :param files: {image name: ImageStat} of the directory
+    :return: (image count, newest modification time, hash of the names, sizes and modification times)
+    """
+    listing = hashlib.sha1()
+    newest = 0
+    for fn in sorted(files):
+        listing.update((fn + "\0" + str(files[fn].size) + "\0" + str(files[fn].mtime) + "\0").encode())
+        newest = max(newest, files[fn].mtime)
+    return len(files), newest, listing.hexdigest()
+
+
+def get_file_hash(path):
+    """
+    Get the hash of a file content
+    :param path: file to hash
+    :return: hexadecimal hash
+    """
+    content_hash = hashlib.sha1()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            content_hash.update(block)
+    return content_hash.hexdigest()
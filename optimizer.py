@@ -1,41 +1,78 @@
 import os
-import sys
-from zipfile import ZipFile, ZIP_DEFLATED
+import sqlite3
+import time
+from functools import partial
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
 
-from PIL import Image
-from PyQt5.QtCore import QObject, QRunnable, pyqtSignal, pyqtSlot
+from archive import zip_dir, get_zip_path
+from budget import PixelBudget, get_image_pixels, BYTES_PER_PIXEL
+from dedup import find_duplicates, link_or_copy
+from events import OptimizerEvents
+from journal import Journal
+from manifest import Manifest, get_dir_signature
+from pipeline import Pipeline
+from processing import process_job, read_image, write_outputs, init_worker, get_thumb_path, get_webp_path, format_thumb_specs, add_webp_specs, \
+    DEFAULT_THUMB_SPEC, MIN_SAVING, DEFAULT_COMPRESS_PROFILE, DEFAULT_THUMB_PROFILE, PROFILES
+from progress import Progress
+from scanner import scan_dir
+from sprites import make_sprites, get_sprite_map_path, MAX_SHEET_SIZE
+from stats import RunStats
+from utils import get_new_path, ImageStat
 
-from utils import is_file_valid_image, get_current_dir, get_new_path
+ZIP_SETTINGS = "stored-or-deflated"  # stored in the manifest
+SPRITE_CACHE_BYTES = 64 * 1000 * 1000  # most thumbnails kept in memory for the sprite sheets, others are read again
 
 
-class OptimizerSignals(QObject):
+class ImageOptimizer:
     """
-    Store thread signal for communication with the UI
+    Optimisation operations, run in a thread by the UI or directly from the command line
     """
-    finished_signal = pyqtSignal()  # thread has finished
-    new_zip_task_started = pyqtSignal(str)  # tell ui what to display
-    new_thumb_task_started = pyqtSignal(str)  # tell ui what to display
-    new_compress_task_started = pyqtSignal(str) # tell ui what to display
-    zip_done = pyqtSignal()  # finished zipping a folder
-    thumb_done = pyqtSignal()  # finished creating a thumbnail
-    compress_done = pyqtSignal()  # finished compressing an image
-
-
-class ImageOptimizer(QRunnable):
-    """
-    Optimisation operations thread
-    """
-    def __init__(self, dir_list, image_list, parent_path, thumb_path, is_compress, is_zip, is_thumb, quality):
-        super(ImageOptimizer, self).__init__()
+    def __init__(self, dir_list, image_list, parent_path, thumb_path, is_compress, is_zip, is_thumb, quality, workers=1,
+                 is_incremental=False, signals=None, images=None, stats_hook=None, report_path=None, target_size=None,
+                 target_bpp=None, thumb_specs=None, webp_quality=None, min_saving=MIN_SAVING,
+                 compress_profile=DEFAULT_COMPRESS_PROFILE, thumb_profile=DEFAULT_THUMB_PROFILE, memory_budget=None,
+                 is_dedup=False, is_sprite=False, use_hash=False):
         self.dir_list = dir_list
-        self.image_list = image_list
-        self.parent_path = parent_path
-        self.thumb_path = thumb_path
+        self.image_list = image_list  # image paths, any sized iterable like ScanResult.image_list
+        self.images = images if images is not None else {}  # {directory: {image name: ImageStat}} from the scan
+        self.listed_dirs = {}  # {directory: {image name: ImageStat}} of the directories listed as they were not scanned
+        self.parent_path = os.path.normpath(parent_path)  # like the scanner, so thumbnail paths are built right
+        self.thumb_path = os.path.normpath(thumb_path)
         self.is_compress = is_compress
         self.is_zip = is_zip
         self.is_thumb = is_thumb
-        self.quality = quality
-        self.signals = OptimizerSignals()
+        self.quality = quality  # compression quality, or highest quality allowed with a target size
+        self.target_size = target_size  # maximum size of a compressed image in bytes
+        self.target_bpp = target_bpp  # maximum size of a compressed image in bits per pixel
+        self.quality_hints = {}  # {directory: quality that fitted the target for the last image}
+        self.thumb_specs = thumb_specs if thumb_specs else [DEFAULT_THUMB_SPEC]  # ThumbSpec of each thumbnail
+        self.webp_quality = webp_quality  # quality of the WebP variants of compressed images and JPEG thumbnails
+        self.min_saving = min_saving  # part of the size a re-encode must save, the image is left untouched otherwise
+        self.compress_profile = compress_profile  # name of the encoding profile of compressed images
+        self.thumb_profile = thumb_profile  # name of the encoding profile of thumbnails
+        # Memory budget in bytes of the images decoded at the same time, None for no limit
+        self.budget = PixelBudget(memory_budget // BYTES_PER_PIXEL) if memory_budget else None
+        self.is_dedup = is_dedup  # process identical images once, and link (or copy) the outputs for the others
+        self.duplicates = {}  # {duplicate path: path of the first image with the same content}
+        self.is_sprite = is_sprite  # also pack the first thumbnails of each directory into sprite sheets
+        self.sprite_thumbs = {}  # {image path: encoded first thumbnail} made by this run, for the sprite sheets
+        self.sprite_thumbs_bytes = 0
+        self.originals = set()  # images with duplicates
+        self.waiting = {}  # {image path: [its job, jobs of its duplicates done once the image is processed]}
+        self.processed_originals = {}  # {image path: (its job, ImageStat after compression)} of originals done
+        if webp_quality is not None:
+            self.thumb_specs = add_webp_specs(self.thumb_specs, webp_quality)
+        self.workers = workers  # number of processes (threads for zips) used in parallel, 1 to stay in this thread
+        self.is_incremental = is_incremental  # skip images and folders unchanged since the last run
+        self.use_hash = use_hash  # also identify images by their content, so touched or copied images are skipped
+        self.manifest = None
+        self.journal = None
+        self.stats = RunStats(stats_hook)  # stats_hook is called with the current report about every second
+        self.report_path = report_path  # JSON file the run report is written to
+        self.report = None  # report of the last run
+        self.signals = signals if signals is not None else OptimizerEvents()
+        self.progress = Progress(self.signals.progress_signal)
         self.should_stop = False
 
     def stop(self):
@@ -52,118 +89,520 @@ class ImageOptimizer(QRunnable):
         """
         return self.should_stop
 
-    def compress_images(self):
+    def run_jobs(self, function, jobs, job_started, job_done, job_failed):
         """
-        Compress images in jpg format to reduce their file size
+        Run function(*job) for each job, one after another or in a thread pool if more than one worker is set
+        Images go through the Pipeline instead, the jobs run here spend most of their time in I/O or in Pillow
+        and zlib, which release the GIL
+        Jobs are submitted a few at a time so stopping the thread cancels the ones not started yet
+        A failing job does not stop the others
 
+        :param function: function to run for each job
+        :param jobs: list of argument tuples
+        :param job_started: called with the job before it is run
+        :param job_done: called with the job and its result once it is finished
+        :param job_failed: called with the job and the exception it raised
         :return:
         """
-        print("Compressing images...")
-        for current_img in self.image_list:
-            self.signals.new_compress_task_started.emit("Compression de '" + current_img + "' ...")
+        if self.workers <= 1:
+            for job in jobs:
+                job_started(job)
+                if self.is_aborted():
+                    break
+                try:
+                    result = function(*job)
+                except Exception as e:
+                    job_failed(job, e)
+                else:
+                    job_done(job, result)
+            return
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = {}
+            for job in jobs:
+                if self.is_aborted():
+                    break
+                if len(pending) >= self.workers * 2:
+                    self.wait_jobs(pending, job_done, job_failed, FIRST_COMPLETED)
+                job_started(job)
+                pending[executor.submit(function, *job)] = job
             if self.is_aborted():
-                break
-            img = Image.open(current_img)
-            img.save(current_img, optimize=True, quality=int(self.quality))
-            self.signals.compress_done.emit()
-        print("COMPRESSION FINISHED")
-        if self.is_aborted():
-            self.signals.new_compress_task_started.emit("Compression annulée")
-        else:
-            self.signals.new_compress_task_started.emit("Compression terminée")
+                for future in pending:
+                    future.cancel()
+            self.wait_jobs(pending, job_done, job_failed, ALL_COMPLETED)
 
-    def zip_dir_list(self):
+    @staticmethod
+    def wait_jobs(pending, job_done, job_failed, return_when):
         """
-        Compress images in all the specified directories
-        Create one zip per folder
+        Wait for submitted jobs to finish and remove them from the pending jobs
 
+        :param pending: dict of future: job
+        :param job_done: called with the job and its result once it is finished
+        :param job_failed: called with the job and the exception it raised
+        :param return_when: FIRST_COMPLETED or ALL_COMPLETED
         :return:
         """
-        for path in self.dir_list:
-            if self.is_aborted():
-                break
-            self.zip_dir(path)
-        print("ZIPPING FINISHED")
-        if self.is_aborted():
-            self.signals.new_zip_task_started.emit("Compression en .zip annulée")
+        done, _ = wait(pending, return_when=return_when)
+        for future in done:
+            job = pending.pop(future)
+            if future.cancelled():
+                continue
+            try:
+                result = future.result()
+            except Exception as e:
+                job_failed(job, e)
+            else:
+                job_done(job, result)
+
+    def process_images(self):
+        """
+        Compress images in jpg format to reduce their file size and/or create their thumbnails,
+        decoding each image only once
+        Images already processed with the same settings are skipped in incremental mode
+
+        :return:
+        """
+        print("Processing images...")
+        if self.is_compress:
+            self.progress.start("compress", len(self.image_list))
+        if self.is_thumb:
+            self.progress.start("thumb", len(self.image_list))
+        process = partial(process_job, thumb_specs=self.thumb_specs, target_size=self.target_size,
+                           target_bpp=self.target_bpp, webp_quality=self.webp_quality, min_saving=self.min_saving,
+                           compress_profile=self.compress_profile, thumb_profile=self.thumb_profile)
+        if self.workers > 1:
+            executor = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker)
         else:
-            self.signals.new_zip_task_started.emit("Compression en .zip terminée")
+            executor = ThreadPoolExecutor(max_workers=1)  # still overlaps with reading and writing
+        with executor:
+            # Enough jobs are read ahead for each worker to start a new one as soon as it is done
+            write = partial(write_outputs, kept_spec=self.thumb_specs[0] if self.is_sprite else None)
+            pipeline = Pipeline(read_image, process, write, executor, self.workers * 2, self.workers * 2,
+                                self.workers * 2)
+            pipeline.run(self.get_image_jobs(), self.image_started, self.image_done, self.image_failed,
+                         self.is_aborted, self.budget, self.get_image_cost)
+        print("IMAGES FINISHED")
+        if self.is_compress:
+            if self.is_aborted():
+                self.progress.finish("compress", "Compression annulée")
+            else:
+                self.progress.finish("compress", "Compression terminée")
+        if self.is_thumb:
+            if self.is_aborted():
+                self.progress.finish("thumb", "Miniatures annulées")
+            else:
+                self.progress.finish("thumb", "Miniatures terminées")
 
-    def zip_dir(self, path):
+    def get_image_jobs(self):
         """
-        Compress images in the specified directory
-        Sub directories are ignored
-        Create one zip per folder
+        Get the processing job of each image, skipping images already processed
+        With deduplication, only images still to process are hashed, and a duplicate gets the outputs of its
+        original when the original makes every output it needs: at once if the original is already processed,
+        once it is processed otherwise
+
+        :return: generator of (image path, compression quality or None, thumbnail path or None, quality hint)
+        """
+        pending = self.get_pending_images()
+        if self.is_dedup:
+            pending = list(pending)
+            print("Looking for duplicates...")
+            self.duplicates = find_duplicates([current_img for current_img, quality, thumb_filename in pending],
+                                              self.get_image_stat)
+            self.originals = set(self.duplicates.values())
+            print(str(len(self.duplicates)) + " duplicates found")
+        for current_img, quality, thumb_filename in pending:
+            # Jobs are made when submitted, so the hint comes from the last finished image of the directory
+            job = current_img, quality, thumb_filename, self.quality_hints.get(os.path.dirname(current_img))
+            processed = self.processed_originals.get(self.duplicates.get(current_img))
+            original = self.waiting.get(self.duplicates.get(current_img))
+            if processed is not None and self.is_covered(job, processed[0]):
+                # The original was processed before this job was made, its outputs are linked right away
+                try:
+                    self.duplicate_done(processed[0], processed[1], job)
+                except OSError as e:
+                    self.image_failed(job, e)
+            elif original is not None and self.is_covered(job, original[0]):
+                original.append(job)  # every output it needs is made for the original image
+            else:
+                if current_img in self.originals:
+                    self.waiting[current_img] = [job]
+                yield job
 
-        :param path: directory to get files in
+    @staticmethod
+    def is_covered(duplicate, job):
+        """
+        :param duplicate: job of a duplicate
+        :param job: job of the image with the same content
+        :return: True if the job makes every output the duplicate needs
+        """
+        return (duplicate[1] is None or job[1] is not None) and (duplicate[2] is None or job[2] is not None)
+
+    def get_pending_images(self):
+        """
+        Get the outputs each image still needs, images already processed are counted as skipped
+
+        :return: generator of (image path, compression quality or None, thumbnail path or None)
+        """
+        for current_img in self.image_list:
+            quality = None
+            thumb_filename = None
+            stat = self.get_image_stat(current_img)
+            if self.is_compress and not self.is_up_to_date(
+                    current_img, "compress", self.get_compress_settings(), stat,
+                    get_webp_path(current_img) if self.webp_quality is not None else None):
+                quality = self.quality
+            if self.is_thumb:
+                filename = get_new_path(current_img, self.parent_path, self.thumb_path)
+                if not self.is_up_to_date(current_img, "thumb", self.get_thumb_settings(), stat,
+                                          get_thumb_path(filename, self.thumb_specs[0])):
+                    thumb_filename = filename
+            if quality is None and thumb_filename is None:
+                self.stats.add_skipped("image")
+                self.emit_image_done()
+                continue
+            yield current_img, quality, thumb_filename
+
+    def get_image_cost(self, job, read_result):
+        """
+        Get the pixels an image job may decode, read from the image header
+        Thumbnails of JPEG images are decoded at a reduced scale, but the full size is counted to stay safe
+
+        :param job: (image path, compression quality or None, thumbnail path or None, quality hint)
+        :param read_result: (file content, measures) from read_image
+        :return: decoded pixels, an image larger than the whole budget is processed alone
+        """
+        return get_image_pixels(BytesIO(read_result[0]))
+
+    def image_started(self, job):
+        """
+        Tell the UI an image is being processed
+
+        :param job: (image path, compression quality or None, thumbnail path or None, quality hint)
         :return:
         """
-        files_list = os.listdir(path)
-        print("Creating .zip '" + path + "'", end="")
-        self.signals.new_zip_task_started.emit("Création du .zip pour '" + path + "' ...")
-        with ZipFile(os.path.join(path, get_current_dir(path)) + ".zip", "w", ZIP_DEFLATED) as zip_file:
-            for fn in files_list:
-                if not fn.endswith("zip") and is_file_valid_image(fn):
-                    print(".", end="")
-                    absolute_file_name = os.path.join(path, fn)
-                    zippped_file_name = absolute_file_name[len(path) + len(os.sep):]  # XXX: relative path
-                    zip_file.write(absolute_file_name, zippped_file_name)
-        print("done")
-        self.signals.zip_done.emit()
+        if job[1] is not None:
+            self.progress.set_task("compress", "Compression de '" + job[0] + "' ...")
+        if job[2] is not None:
+            self.progress.set_task("thumb", "Création de la miniature pour '" + job[0] + "' ...")
 
-    def create_thumbs(self):
+    def image_done(self, job, result):
         """
-        Compress images to a 140x105 format, cropping in the middle if needed
+        Record the processed image in the manifest and the stats, and tell the UI
 
+        :param job: (image path, compression quality or None, thumbnail path or None, quality hint)
+        :param result: (ImageStat of the compressed image or None if it was not compressed, quality used, measures,
+                        first thumbnail kept for the sprite sheets or None)
         :return:
         """
-        print("Creating thumbnails...")
-        size = 140, 105  # 4/3 format
-        for current_img in self.image_list:
-            self.signals.new_thumb_task_started.emit("Création de la miniature pour '" + current_img + "' ...")
-            if self.is_aborted():
-                break
-            # If height is higher we resize vertically, if not we resize horizontally
-            img = Image.open(current_img)
-            # Get current and desired ratio for the images
-            img_ratio = img.size[0] / float(img.size[1])
-            ratio = size[0] / float(size[1])
-            # The image is scaled/cropped vertically or horizontally depending on the ratio
-            if ratio > img_ratio:
-                img = img.resize((size[0], round(size[0] * img.size[1] / img.size[0])), Image.BILINEAR)
-                # Crop in the middle
-                box = (0, round((img.size[1] - size[1]) / 2), img.size[0], round((img.size[1] + size[1]) / 2))
-                img = img.crop(box)
-            elif ratio < img_ratio:
-                img = img.resize((round(size[1] * img.size[0] / img.size[1]), size[1]), Image.BILINEAR)
-                # Crop in the middle
-                box = (round((img.size[0] - size[0]) / 2), 0, round((img.size[0] + size[0]) / 2), img.size[1])
-                img = img.crop(box)
+        stat, quality, measures, thumb = result
+        if thumb is not None and self.sprite_thumbs_bytes + len(thumb) <= SPRITE_CACHE_BYTES:
+            self.sprite_thumbs[job[0]] = thumb
+            self.sprite_thumbs_bytes += len(thumb)
+        self.stats.add_measures("image", job[0], os.path.dirname(job[0]), measures)
+        if quality is not None and self.is_target_size():
+            self.quality_hints[os.path.dirname(job[0])] = int(quality)
+        if stat is not None:
+            self.get_dir_images(os.path.dirname(job[0]))[os.path.basename(job[0])] = stat
+        if job[1] is not None:
+            self.record(job[0], "compress", self.get_compress_settings(), stat)
+        if job[2] is not None:
+            self.record(job[0], "thumb", self.get_thumb_settings(), self.get_image_stat(job[0]))
+        self.emit_image_done()
+        if job[0] in self.originals:
+            self.processed_originals[job[0]] = (job, stat)
+        for duplicate in self.waiting.pop(job[0], [job])[1:]:
+            try:
+                self.duplicate_done(job, stat, duplicate)
+            except OSError as e:
+                self.image_failed(duplicate, e)
+
+    def duplicate_done(self, job, stat, duplicate):
+        """
+        Give a duplicate the outputs of the identical image processed in its place, as hard links or copies
+
+        :param job: job of the image processed
+        :param stat: ImageStat of the compressed image, None if it was not compressed
+        :param duplicate: job of the duplicate, its outputs are a subset of the ones of the processed image
+        :return:
+        """
+        start = time.perf_counter()
+        path = duplicate[0]
+        if duplicate[1] is not None:
+            # Even if the image was left untouched, the duplicate then takes no space with a hard link
+            link_or_copy(job[0], path)
+            self.get_dir_images(os.path.dirname(path))[os.path.basename(path)] = stat
+            if self.webp_quality is not None:
+                link_or_copy(get_webp_path(job[0]), get_webp_path(path))
+        if duplicate[2] is not None:
+            for spec in self.thumb_specs:
+                link_or_copy(get_thumb_path(job[2], spec), get_thumb_path(duplicate[2], spec))
+        self.stats.add_measures("image", path, os.path.dirname(path), {"dedup": time.perf_counter() - start})
+        if duplicate[1] is not None:
+            self.record(path, "compress", self.get_compress_settings(), stat)
+        if duplicate[2] is not None:
+            self.record(path, "thumb", self.get_thumb_settings(), self.get_image_stat(path))
+        self.emit_image_done()
+
+    def image_failed(self, job, error):
+        """
+        Record an image that could not be processed, the next images are still processed
+
+        :param job: (image path, compression quality or None, thumbnail path or None, quality hint)
+        :param error: exception raised while processing the image
+        :return:
+        """
+        print("Cannot process '" + job[0] + "': " + str(error))
+        self.stats.add_failure("image", job[0], error)
+        self.emit_image_done()
+        for duplicate in self.waiting.pop(job[0], [job])[1:]:
+            self.image_failed(duplicate, error)
+
+    def emit_image_done(self):
+        """
+        Count an image processed, skipped or failed in the progress
+        :return:
+        """
+        if self.is_compress:
+            self.progress.add("compress")
+        if self.is_thumb:
+            self.progress.add("thumb")
+
+    def is_up_to_date(self, path, action, settings, signature, output=None):
+        """
+        Check if an action can be skipped: it was done by the interrupted run of this job,
+        or in incremental mode, the manifest shows it was already done
+
+        :param path: file or directory the action is done on
+        :param action: name of the action (compress, thumb, zip)
+        :param settings: string describing the settings used by the action
+        :param signature: current ImageStat of the file, or get_dir_signature of the directory
+        :param output: file created by the action, which must still exist
+        :return: True if the action can be skipped, False otherwise
+        """
+        if self.journal is not None and self.journal.is_done(action, path):
+            return True
+        return self.manifest is not None and self.manifest.is_up_to_date(path, action, settings, signature, output)
+
+    def record(self, path, action, settings, signature):
+        """
+        Record a finished action in the journal and in the manifest
+
+        :param path: file or directory the action was done on
+        :param action: name of the action (compress, thumb, zip)
+        :param settings: string describing the settings used by the action
+        :param signature: ImageStat of the file after the action, or get_dir_signature of the directory
+        :return:
+        """
+        if self.journal is not None:
+            self.journal.add(action, path)
+        if self.manifest is not None:
+            self.manifest.record(path, action, settings, signature)
+
+    def get_dir_images(self, path):
+        """
+        Get the images of a directory from the scan result, listing the directory only if it was not scanned
+
+        :param path: directory to get images in
+        :return: {image name: ImageStat}, kept up to date when images are compressed
+        """
+        files = self.images.get(path)
+        if files is None:
+            # Kept apart: the scan result may be iterated while images are processed
+            if path not in self.listed_dirs:
+                self.listed_dirs[path] = scan_dir(path)[0]
+            files = self.listed_dirs[path]
+        return files
+
+    def get_image_stat(self, path):
+        """
+        Get the size and modification time of an image from the scan result
+
+        :param path: image path
+        :return: ImageStat
+        """
+        stat = self.get_dir_images(os.path.dirname(path)).get(os.path.basename(path))
+        if stat is None:
+            stat = os.stat(path)
+            stat = ImageStat(stat.st_size, stat.st_mtime_ns)
+        return stat
+
+    def get_compress_settings(self):
+        """
+        :return: string describing the compression settings, stored in the manifest
+        """
+        settings = "quality=" + str(int(self.quality))
+        if self.target_size is not None:
+            settings += ";target_size=" + str(self.target_size)
+        elif self.target_bpp is not None:
+            settings += ";target_bpp=" + str(self.target_bpp)
+        if self.webp_quality is not None:
+            settings += ";webp=" + str(int(self.webp_quality))
+        if self.compress_profile != DEFAULT_COMPRESS_PROFILE:
+            settings += ";profile=" + self.compress_profile
+        return settings
+
+    def is_target_size(self):
+        """
+        :return: True if the quality is searched to fit a target size, False if the quality is used as is
+        """
+        return self.target_size is not None or self.target_bpp is not None
+
+    def get_thumb_settings(self):
+        """
+        :return: string describing the thumbnail settings, stored in the manifest
+        """
+        settings = "size=" + format_thumb_specs(self.thumb_specs)
+        if self.thumb_profile != DEFAULT_THUMB_PROFILE:
+            settings += ";profile=" + self.thumb_profile
+        return settings
+
+    def get_job_settings(self):
+        """
+        :return: string describing the whole job, a journal is only resumed by a job with the same settings
+        """
+        settings = [self.parent_path]
+        if self.is_compress:
+            settings.append("compress:" + self.get_compress_settings())
+        if self.is_thumb:
+            settings.append("thumb:" + self.get_thumb_settings() + ";path=" + self.thumb_path)
+        if self.is_zip:
+            settings.append("zip:" + ZIP_SETTINGS)
+        if self.is_thumb and self.is_sprite:
+            settings.append("sprite:" + self.get_sprite_settings())
+        return "\t".join(settings)
+
+    def get_sprite_settings(self):
+        """
+        :return: string describing the sprite sheets settings, stored in the manifest
+        """
+        return self.get_thumb_settings() + ";sheet=" + str(MAX_SHEET_SIZE)
+
+    def sprite_dir_list(self):
+        """
+        Pack the first thumbnails of each directory into sprite sheets, several directories at a time
+        Thumbnails made by this run are taken from memory, the others are read from the thumbnail directory
+
+        :return:
+        """
+        self.progress.start("sprite", len(self.dir_list))
+        signatures = {}
+        gallery_dirs = {}  # {thumbnail directory: gallery directory}
+
+        def get_jobs():
+            for path in self.dir_list:
+                signatures[path] = get_dir_signature(self.get_dir_images(path))
+                thumb_dir = get_new_path(path, self.parent_path, self.thumb_path)
+                gallery_dirs[thumb_dir] = path
+                if self.is_up_to_date(path, "sprite", self.get_sprite_settings(), signatures[path],
+                                      get_sprite_map_path(thumb_dir)):
+                    self.stats.add_skipped("sprite")
+                    self.progress.add("sprite")
+                    continue
+                thumbs = []
+                for name in sorted(self.get_dir_images(path)):
+                    data = self.sprite_thumbs.pop(os.path.join(path, name), None)
+                    if data is None:
+                        try:
+                            with open(get_thumb_path(os.path.join(thumb_dir, name), self.thumb_specs[0]),
+                                      "rb") as file:
+                                data = file.read()
+                        except OSError:
+                            continue  # the thumbnail could not be made, the failure is already reported
+                    thumbs.append((name, data))
+                yield thumb_dir, thumbs, self.thumb_specs[0], PROFILES[self.thumb_profile]
+
+        def job_started(job):
+            self.progress.set_task("sprite", "Création des planches de miniatures pour '" + job[0] + "' ...")
+
+        def job_done(job, measures):
+            path = gallery_dirs[job[0]]
+            self.stats.add_measures("sprite", path, path, measures)
+            self.record(path, "sprite", self.get_sprite_settings(), signatures[path])
+            self.progress.add("sprite")
+
+        def job_failed(job, error):
+            print("Cannot create the sprite sheets for '" + job[0] + "': " + str(error))
+            self.stats.add_failure("sprite", gallery_dirs[job[0]], error)
+            self.progress.add("sprite")
+
+        # The thumbnails are already in memory, sending them to other processes would cost more than packing them
+        self.run_jobs(make_sprites, get_jobs(), job_started, job_done, job_failed)
+        self.sprite_thumbs = {}
+        self.sprite_thumbs_bytes = 0
+        print("SPRITES FINISHED")
+        if self.is_aborted():
+            self.progress.finish("sprite", "Planches de miniatures annulées")
+        else:
+            self.progress.finish("sprite", "Planches de miniatures terminées")
+
+    def zip_dir_list(self):
+        """
+        Compress images in all the specified directories, several directories at a time
+        Create one zip per folder
+
+        :return:
+        """
+        self.progress.start("zip", len(self.dir_list))
+        jobs = []
+        signatures = {}
+        for path in self.dir_list:
+            signatures[path] = get_dir_signature(self.get_dir_images(path))
+            if self.is_up_to_date(path, "zip", ZIP_SETTINGS, signatures[path], get_zip_path(path)):
+                self.stats.add_skipped("zip")
+                self.progress.add("zip")
             else:
-                img = img.resize((size[0], size[1]), Image.BILINEAR)
-                # If the scale is the same, we do not need to crop
-            filename = get_new_path(current_img, self.parent_path, self.thumb_path)
-            if not os.path.exists(os.path.dirname(filename)):
-                try:
-                    os.makedirs(os.path.dirname(filename))
-                except OSError:
-                    sys.exit(
-                        "Fatal : Directory '" + os.path.dirname(filename) + "' does not exist and cannot be created")
-
-            img.save(filename, "JPEG")
-            self.signals.thumb_done.emit()
-        print("THUMBNAILS FINISHED")
+                jobs.append((path, dict(self.get_dir_images(path))))
+
+        def job_started(job):
+            self.progress.set_task("zip", "Création du .zip pour '" + job[0] + "' ...")
+
+        def job_done(job, measures):
+            self.stats.add_measures("zip", job[0], job[0], measures)
+            self.record(job[0], "zip", ZIP_SETTINGS, signatures[job[0]])
+            self.progress.add("zip")
+
+        def job_failed(job, error):
+            print("Cannot create the .zip for '" + job[0] + "': " + str(error))
+            self.stats.add_failure("zip", job[0], error)
+            self.progress.add("zip")
+
+        # Zipping is mostly disk bound, threads are enough
+        self.run_jobs(zip_dir, jobs, job_started, job_done, job_failed)
+        print("ZIPPING FINISHED")
         if self.is_aborted():
-            self.signals.new_thumb_task_started.emit("Miniatures annulées")
+            self.progress.finish("zip", "Compression en .zip annulée")
         else:
-            self.signals.new_thumb_task_started.emit("Miniatures terminées")
+            self.progress.finish("zip", "Compression en .zip terminée")
 
-    @pyqtSlot()
     def run(self):
-        if self.is_compress:
-            self.compress_images()
-        if self.is_zip:
-            self.zip_dir_list()
-        if self.is_thumb:
-            self.create_thumbs()
-        self.signals.finished_signal.emit()
+        self.stats = RunStats(self.stats.hook)
+        try:
+            self.journal = Journal(self.parent_path, self.get_job_settings())
+        except OSError as e:
+            print("Cannot open the journal, an interrupted job will not be resumed: " + str(e))
+        if self.is_incremental:
+            try:
+                self.manifest = Manifest(self.parent_path, self.use_hash)
+            except sqlite3.Error as e:
+                print("Cannot open the manifest, every image will be processed: " + str(e))
+        is_finished = False
+        try:
+            if self.is_compress or self.is_thumb:
+                self.process_images()
+            if self.is_thumb and self.is_sprite:
+                self.sprite_dir_list()
+            if self.is_zip:
+                self.zip_dir_list()
+            is_finished = not self.is_aborted()
+        finally:
+            # Also after an unexpected error: the progress is saved, the journal kept to resume, and the UI told
+            if self.manifest is not None:
+                self.manifest.close()
+                self.manifest = None
+            if self.journal is not None:
+                self.journal.close(is_finished)
+                self.journal = None
+            self.stats.finish()
+            self.report = self.stats.get_report()
+            if self.report_path is not None:
+                self.stats.write(self.report_path)
+            self.signals.finished_signal.emit()
@@ -0,0 +1,125 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+READ_AHEAD_BYTES = 256 * 1000 * 1000  # most file content read and waiting to be processed
+
+
+class Pipeline:
+    """
+    Run jobs through three overlapping stages: read in an I/O thread, process in a pool, write in an I/O thread,
+    so the disk keeps working while images are encoded and the CPU while files are read or written
+    Each stage holds a bounded number of jobs: a slow stage holds back the previous ones
+    Every callback is called in the thread running the pipeline
+    """
+    def __init__(self, read, process, write, executor, max_processing, read_ahead, write_behind):
+        self.read = read  # read(job): read result, a tuple whose first item is the content read
+        self.process = process  # process(job, read result): process result, must be picklable for a process pool
+        self.write = write  # write(job, process result): job result
+        self.executor = executor  # pool running the process stage
+        self.max_processing = max_processing  # most jobs in the process stage
+        self.read_ahead = read_ahead  # most jobs read and waiting to be processed
+        self.write_behind = write_behind  # most jobs processed and waiting to be written
+
+    def run(self, jobs, job_started, job_done, job_failed, is_aborted, budget=None, job_cost=None):
+        """
+        Run every job, stopping early if aborted: jobs not started yet are dropped, started ones are finished
+        If a worker process dies (killed by the system when out of memory), the pool cannot run anything anymore:
+        the jobs running and the remaining ones fail
+
+        :param jobs: iterable of jobs, only consumed as the read stage needs them
+        :param job_started: called with the job when it starts being processed
+        :param job_done: called with the job and its result once it is written
+        :param job_failed: called with the job and the exception raised by any stage
+        :param is_aborted: function telling if the pipeline must stop
+        :param budget: PixelBudget the process stage is limited by, None for no limit
+        :param job_cost: function giving the decoded pixels of a job from the job and its read result
+        :return:
+        """
+        jobs = iter(jobs)
+        is_exhausted = False
+        reads = {}  # {future: job}
+        read = deque()  # (job, read result, size) waiting to be processed, in read order
+        read_bytes = 0
+        processes = {}  # {future: job}
+        writes = {}  # {future: job}
+        broken = None  # BrokenProcessPool raised by the pool, every job left fails with it
+        with ThreadPoolExecutor(max_workers=1) as reader, ThreadPoolExecutor(max_workers=1) as writer:
+            while True:
+                if is_aborted():
+                    for future in reads:
+                        future.cancel()
+                    for future in processes:
+                        future.cancel()
+                    read.clear()
+                    is_exhausted = True
+                if broken is not None:
+                    for future in reads:
+                        future.cancel()
+                    for job, read_result, size in read:
+                        job_failed(job, broken)
+                    read.clear()
+                    for job in jobs:
+                        if is_aborted():
+                            break
+                        job_failed(job, broken)
+                    is_exhausted = True
+                # Read ahead
+                while not is_exhausted and len(reads) + len(read) < self.read_ahead \
+                        and (read_bytes < READ_AHEAD_BYTES or len(read) == 0):
+                    job = next(jobs, None)
+                    if job is None:
+                        is_exhausted = True
+                    else:
+                        reads[reader.submit(self.read, job)] = job
+                # Start processing the jobs read, unless too many outputs wait to be written
+                while len(read) > 0 and len(processes) < self.max_processing \
+                        and len(processes) + len(writes) < self.max_processing + self.write_behind:
+                    job, read_result, size = read[0]
+                    cost = job_cost(job, read_result) if budget is not None else 0
+                    if budget is not None and len(processes) > 0 and not budget.can_admit(cost):
+                        break
+                    read.popleft()
+                    read_bytes -= size
+                    job_started(job)
+                    try:
+                        future = self.executor.submit(self.process, job, read_result)
+                    except BrokenProcessPool as e:
+                        broken = e
+                        job_failed(job, e)
+                        break
+                    processes[future] = job
+                    if budget is not None:
+                        budget.admit(future, cost)
+                if len(reads) + len(read) + len(processes) + len(writes) == 0 and is_exhausted:
+                    break
+                done, _ = wait(list(reads) + list(processes) + list(writes), return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in reads:
+                        job = reads.pop(future)
+                        if future.cancelled() and broken is not None:
+                            job_failed(job, broken)
+                        elif not future.cancelled():
+                            if future.exception() is not None:
+                                job_failed(job, future.exception())
+                            else:
+                                size = len(future.result()[0])
+                                read.append((job, future.result(), size))
+                                read_bytes += size
+                    elif future in processes:
+                        job = processes.pop(future)
+                        if budget is not None:
+                            budget.release(future)
+                        if not future.cancelled():
+                            if isinstance(future.exception(), BrokenProcessPool):
+                                broken = future.exception()
+                            if future.exception() is not None:
+                                job_failed(job, future.exception())
+                            else:
+                                writes[writer.submit(self.write, job, future.result())] = job
+                    else:
+                        job = writes.pop(future)
+                        if future.exception() is not None:
+                            job_failed(job, future.exception())
+                        else:
+                            job_done(job, future.result())
@@ -0,0 +1,556 @@
+import os
+import signal
+import sys
+import time
+from collections import namedtuple
+from io import BytesIO
+
+from PIL import Image, ImageOps, JpegImagePlugin
+
+from utils import ImageStat, get_temp_path
+
+ThumbSpec = namedtuple("ThumbSpec", ["width", "height", "mode", "format", "quality", "suffix"])
+DEFAULT_THUMB_SPEC = ThumbSpec(140, 105, "crop", "JPEG", 75, "")  # 4/3 format, named like the image
+THUMB_MODES = "crop", "fit"  # crop: exactly the spec size, cropped in the middle; fit: inside the spec size
+THUMB_FORMATS = {"jpeg": "JPEG", "jpg": "JPEG", "png": "PNG", "webp": "WEBP"}
+FORMAT_MODES = {"JPEG": ("RGB", "L", "CMYK"), "WEBP": ("RGB", "RGBA")}  # modes each format can encode
+EncodingProfile = namedtuple("EncodingProfile", ["exif", "icc", "xmp", "progressive", "subsampling", "png_level"])
+# exif, icc, xmp: keep the metadata of the image; an image losing its EXIF data is rotated as its orientation says
+# subsampling: JPEG chroma subsampling, "4:2:0", "4:4:4" or "keep" (the one of a JPEG image), None for the default
+# png_level: zlib compression level of PNG images, 9 also optimizes the PNG filters
+PROFILES = {
+    "web": EncodingProfile(False, True, False, True, "4:2:0", 9),  # small and progressive, colors kept
+    "thumbnail": EncodingProfile(False, False, False, False, "4:2:0", 9),  # smallest, progressive does not pay off
+    "archive": EncodingProfile(True, True, True, False, "keep", 9),  # every metadata and chroma detail kept
+}
+DEFAULT_COMPRESS_PROFILE = "web"
+DEFAULT_THUMB_PROFILE = "thumbnail"
+MIN_SAVING = 0.05  # re-encoded images saving less than this part of their size are left untouched
+# Luminance quantization table of the JPEG standard, scaled by the encoder quality (libjpeg scaling)
+STANDARD_LUMINANCE_TABLE = [
+    16, 11, 10, 16, 24, 40, 51, 61, 12, 12, 14, 19, 26, 58, 60, 55, 14, 13, 16, 24, 40, 57, 69, 56,
+    14, 17, 22, 29, 51, 87, 80, 62, 18, 22, 37, 56, 68, 109, 103, 77, 24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101, 72, 92, 95, 98, 112, 100, 103, 99,
+]
+MIN_QUALITY = 10  # lowest quality tried when searching for a target size
+MAX_TRIALS = 6  # encodes tried when searching for a target size, the search is exact after 7
+QUALITY_FORMATS = "JPEG", "WEBP"  # formats whose size depends on the quality
+
+
+def init_worker():
+    """
+    Initialize a worker process: interruptions are handled by the parent process, which stops the optimizer
+    :return:
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def process_image(path, quality=None, thumb_filename=None, quality_hint=None, thumb_specs=(DEFAULT_THUMB_SPEC,),
+                  target_size=None, target_bpp=None, webp_quality=None, min_saving=MIN_SAVING,
+                  compress_profile=DEFAULT_COMPRESS_PROFILE, thumb_profile=DEFAULT_THUMB_PROFILE, data=b""):
+    """
+    Compress an image and/or create its thumbnails in memory, decoding the image only once
+    Nothing is read nor written here, so disk access overlaps with the processing of other images
+    Thumbnails are made from the original image, not from the compressed one
+    With a target size, the highest quality up to the given one that fits in the target is used
+    Images already compressed enough are left untouched, see is_compressed_enough
+    A WebP variant of the compressed image can be written next to it, see get_webp_path
+
+    :param path: path of the image
+    :param quality: quality of the compressed image, None to leave the image untouched
+    :param thumb_filename: path of the thumbnail, see get_thumb_path, None to skip the thumbnails
+    :param quality_hint: quality that fitted the target for a similar image, tried first
+    :param thumb_specs: ThumbSpec of each thumbnail to create
+    :param target_size: maximum size of the compressed image in bytes
+    :param target_bpp: maximum size of the compressed image in bits per pixel, used if target_size is not set
+    :param webp_quality: quality of the WebP variant of the compressed image, None to skip it
+    :param min_saving: part of the size a re-encode must save, the image is left untouched otherwise
+    :param compress_profile: name of the PROFILES used for the compressed image and its WebP variant
+    :param thumb_profile: name of the PROFILES used for the thumbnails
+    :param data: content of the image file
+    :return: (outputs: list of (path, encoded image) to write, compressed image first, quality used or None,
+              measures: seconds spent in each stage and bytes in and out, see RunStats.add_measures)
+    """
+    measures = {}
+    outputs = []
+    clock = time.perf_counter()
+    img = Image.open(BytesIO(data))
+    if quality is not None and target_size is None and target_bpp is not None:
+        target_size = int(target_bpp * img.size[0] * img.size[1] / 8)
+    # Only the header is read yet: images already compressed enough are not decoded for compression
+    is_kept = quality is not None and is_compressed_enough(img, len(data), int(quality), target_size)
+    if quality is None or (is_kept and webp_quality is None):
+        # Let the JPEG decoder scale the image down by 1/2, 1/4 or 1/8 while staying larger than the largest
+        # thumbnail, so the full resolution bitmap is never decoded. Other formats ignore it
+        img.draft(img.mode, (max(spec.width for spec in thumb_specs), max(spec.height for spec in thumb_specs)))
+    if thumb_filename is not None or (quality is not None and (not is_kept or webp_quality is not None)):
+        img.load()
+        clock = measure(measures, "decode", clock)
+    if quality is not None:
+        compressed = data
+        profile = PROFILES[compress_profile]
+        # An image kept without a WebP copy is never decoded, neither rotated nor converted
+        source = apply_profile(img, profile) if not is_kept or webp_quality is not None else None
+        if not is_kept:
+            params = get_save_params(img, img.format, profile)
+            is_searched = target_size is not None and img.format in QUALITY_FORMATS
+            if is_searched:
+                quality, compressed = find_quality(source, img.format, target_size, int(quality), quality_hint,
+                                                   **params)
+            else:
+                compressed = encode_image(source, img.format, quality=int(quality), **params)
+            clock = measure(measures, "encode", clock)
+            # Unless the size was searched for the target, a re-encode saving too little is not worth
+            # the generation loss
+            is_kept = not is_searched and len(compressed) > len(data) * (1 - min_saving)
+        if img.format not in QUALITY_FORMATS:
+            quality = None  # the quality does not apply to this format, it is no hint for the next images
+        if is_kept:
+            compressed = data
+            quality = None
+            measures["compress_kept"] = 1
+        else:
+            outputs.append((path, compressed))
+        measures["compress_input_bytes"] = len(data)
+        measures["compress_output_bytes"] = len(compressed)
+        if webp_quality is not None:
+            webp = encode_image(convert_for_format(source, "WEBP"), "WEBP", quality=int(webp_quality),
+                                **get_save_params(img, "WEBP", profile))
+            clock = measure(measures, "encode", clock)
+            outputs.append((get_webp_path(path), webp))
+            measures["webp_input_bytes"] = len(data)
+            measures["webp_output_bytes"] = len(webp)
+    if thumb_filename is not None:
+        measures["thumb_input_bytes"] = len(data)
+        measures["thumb_output_bytes"] = 0
+        profile = PROFILES[thumb_profile]
+        for spec, thumb in make_thumbs(apply_profile(img, profile), thumb_specs):
+            clock = measure(measures, "resize", clock)
+            thumb = encode_image(convert_for_format(thumb, spec.format), spec.format, quality=spec.quality,
+                                 **get_save_params(img, spec.format, profile))
+            clock = measure(measures, "encode", clock)
+            outputs.append((get_thumb_path(thumb_filename, spec), thumb))
+            measures["thumb_output_bytes"] += len(thumb)
+    return outputs, quality, measures
+
+
+def read_image(job):
+    """
+    Read the file of an image job, first stage of the pipeline
+
+    :param job: (image path, compression quality or None, thumbnail path or None, quality hint)
+    :return: (file content, measures)
+    """
+    clock = time.perf_counter()
+    with open(job[0], "rb") as file:
+        data = file.read()
+    measures = {"read_bytes": len(data)}
+    measure(measures, "read", clock)
+    return data, measures
+
+
+def process_job(job, read_result, **options):
+    """
+    Process an image job read by read_image, second stage of the pipeline
+    Module level function so it can be sent to a worker process
+
+    :param job: (image path, compression quality or None, thumbnail path or None, quality hint)
+    :param read_result: result of read_image
+    :param options: other process_image arguments
+    :return: (outputs, quality used or None, measures), see process_image
+    """
+    data, measures = read_result
+    outputs, quality, process_measures = process_image(*job, data=data, **options)
+    measures.update(process_measures)
+    return outputs, quality, measures
+
+
+def write_outputs(job, process_result, kept_spec=None):
+    """
+    Write the outputs of an image job, last stage of the pipeline
+
+    :param job: (image path, compression quality or None, thumbnail path or None, quality hint)
+    :param process_result: result of process_job
+    :param kept_spec: ThumbSpec of the thumbnail also returned, so it is not read again (sprite sheets)
+    :return: (ImageStat of the image if it was to be compressed or None, quality used or None, measures,
+              encoded thumbnail of kept_spec or None)
+    """
+    outputs, quality, measures = process_result
+    clock = time.perf_counter()
+    kept_path = get_thumb_path(job[2], kept_spec) if kept_spec is not None and job[2] is not None else None
+    kept = None
+    for path, data in outputs:
+        save_output(data, path)
+        if path == kept_path:
+            kept = data
+    stat = None
+    if job[1] is not None:
+        stat = os.stat(job[0])
+        stat = ImageStat(stat.st_size, stat.st_mtime_ns)
+    measure(measures, "write", clock)
+    return stat, quality, measures, kept
+
+
+def is_compressed_enough(img, size, quality, target_size=None):
+    """
+    Check from the image header only if compressing an image is useless: with a target size, the image already
+    fits in it; without, it is a JPEG whose quantization tables show a quality at or below the given one
+    Re-encoding such an image would only lose quality
+
+    :param img: opened image, not decoded
+    :param size: image file size in bytes
+    :param quality: requested quality
+    :param target_size: maximum size in bytes, None to compare qualities
+    :return: True if the image should be left untouched
+    """
+    if target_size is not None:
+        return size <= target_size
+    estimate = estimate_jpeg_quality(img)
+    return estimate is not None and estimate <= quality
+
+
+def estimate_jpeg_quality(img):
+    """
+    Estimate the quality a JPEG was encoded with, from the scaling of its luminance quantization table
+    The estimate matches the quality given to libjpeg based encoders (Pillow, most cameras and editors)
+
+    :param img: opened image
+    :return: estimated quality (1-100), None if the image is not a JPEG
+    """
+    tables = getattr(img, "quantization", None)
+    if img.format != "JPEG" or not tables or len(tables[0]) != len(STANDARD_LUMINANCE_TABLE):
+        return None
+    # Sorted values do not depend on the table order (natural or zigzag, depending on Pillow versions),
+    # and the scaling keeps their order. Values clamped to 255 by low qualities are left out
+    pairs = [(value, standard) for value, standard in zip(sorted(tables[0]), sorted(STANDARD_LUMINANCE_TABLE))
+             if value < 255]
+    if len(pairs) == 0:
+        return 1
+    scale = 100 * sum(value for value, _ in pairs) / sum(standard for _, standard in pairs)
+    if scale <= 100:
+        quality = (200 - scale) / 2
+    else:
+        quality = 5000 / scale
+    return min(100, max(1, round(quality)))
+
+
+def find_quality(img, image_format, target_size, max_quality, quality_hint=None, **params):
+    """
+    Find the highest quality whose encoded image fits in the target size, by bisection in memory
+    The hint is tried first, it usually fits images of the same directory, so the search ends in a few encodes
+    If no quality tried fits, the image is encoded with the lowest quality
+
+    :param img: decoded image
+    :param image_format: Pillow format name, one of QUALITY_FORMATS
+    :param target_size: maximum size in bytes
+    :param max_quality: highest quality allowed
+    :param quality_hint: quality to try first, None to start in the middle
+    :param params: other Pillow save options
+    :return: (quality, encoded image)
+    """
+    low, high = MIN_QUALITY, max_quality
+    best = None
+    quality = min(max(int(quality_hint), low), high) if quality_hint is not None else (low + high + 1) // 2
+    for _ in range(MAX_TRIALS):
+        data = encode_image(img, image_format, quality=quality, **params)
+        if len(data) <= target_size:
+            best = quality, data
+            low = quality + 1
+        else:
+            high = quality - 1
+        if low > high:
+            break
+        quality = (low + high + 1) // 2
+    if best is None:
+        best = MIN_QUALITY, encode_image(img, image_format, quality=MIN_QUALITY, **params)
+    return best
+
+
+def measure(measures, stage, start):
+    """
+    Add the time elapsed since start to a stage
+
+    :param measures: {stage: seconds} to update
+    :param stage: name of the stage
+    :param start: time.perf_counter() when the stage started
+    :return: time.perf_counter() now, start of the next stage
+    """
+    now = time.perf_counter()
+    measures[stage] = measures.get(stage, 0) + now - start
+    return now
+
+
+def make_thumbs(img, specs):
+    """
+    Resize an image to each thumbnail spec, largest first
+    Each size is resized from the smallest previous one still covering it instead of from the full image,
+    which is much faster
+
+    :param img: image to resize
+    :param specs: ThumbSpec of each thumbnail
+    :return: list of (spec, resized image)
+    """
+    thumbs = []
+    sources = [img]  # the image and its reductions, largest first
+    for spec in sorted(specs, key=lambda spec: spec.width * spec.height, reverse=True):
+        size = get_scaled_size(img.size, spec)
+        source = img  # enlarged images are resized from the image itself
+        for reduction in sources:
+            if reduction.size[0] >= size[0] and reduction.size[1] >= size[1]:
+                source = reduction
+        scaled = scale_image(source, spec)
+        if scaled.size[0] < sources[-1].size[0]:
+            sources.append(scaled)  # never resize the next sizes from an enlarged image
+        thumbs.append((spec, crop_image(scaled, (spec.width, spec.height)) if spec.mode == "crop" else scaled))
+    return thumbs
+
+
+def scale_image(img, spec):
+    """
+    Resize the whole image for a thumbnail spec, keeping its ratio
+    In crop mode the image covers the spec size and may be enlarged, in fit mode it fits inside and is only reduced
+
+    :param img: image to resize
+    :param spec: ThumbSpec
+    :return: resized image
+    """
+    size = get_scaled_size(img.size, spec)
+    if spec.mode == "fit" and size[0] >= img.size[0]:
+        return img
+    return img.resize(size, Image.BILINEAR)
+
+
+def get_scaled_size(img_size, spec):
+    """
+    Get the size of an image resized for a thumbnail spec, see scale_image
+
+    :param img_size: (width, height) of the image
+    :param spec: ThumbSpec
+    :return: (width, height) keeping the image ratio, the image size in fit mode if it already fits
+    """
+    # If height is higher we resize vertically, if not we resize horizontally
+    # Get current and desired ratio for the images
+    img_ratio = img_size[0] / float(img_size[1])
+    ratio = spec.width / float(spec.height)
+    if (ratio > img_ratio) == (spec.mode == "crop"):
+        size = spec.width, max(1, round(spec.width * img_size[1] / img_size[0]))
+    else:
+        size = max(1, round(spec.height * img_size[0] / img_size[1])), spec.height
+    if spec.mode == "fit" and size[0] >= img_size[0]:
+        return img_size
+    return size
+
+
+def crop_image(img, size):
+    """
+    Crop an image in the middle
+
+    :param img: image covering the size
+    :param size: (width, height) to keep
+    :return: cropped image, the image itself if it already has the size
+    """
+    if img.size == tuple(size):
+        return img
+    left = round((img.size[0] - size[0]) / 2)
+    top = round((img.size[1] - size[1]) / 2)
+    return img.crop((left, top, left + size[0], top + size[1]))
+
+
+def get_thumb_path(thumb_filename, spec):
+    """
+    Get the path of one thumbnail of an image
+    JPEG thumbnails keep the extension of the image, like the default thumbnail, other formats add their
+    extension to it (img.png.webp), like get_webp_path, so images with the same name do not collide
+
+    :param thumb_filename: path of the image in the thumbnail directory
+    :param spec: ThumbSpec
+    :return: thumbnail path
+    """
+    root, ext = os.path.splitext(thumb_filename)
+    if spec.format != "JPEG":
+        ext += "." + spec.format.lower()
+    return root + spec.suffix + ext
+
+
+def parse_thumb_specs(text):
+    """
+    Read thumbnail specs, comma separated, like "140x105,800x600:fit:webp:80"
+    Each spec is WIDTHxHEIGHT[:crop|fit][:jpeg|png|webp][:quality], crop, jpeg and 75 by default
+    The first thumbnail is named like the image, the next ones get a _WIDTHxHEIGHT suffix
+
+    :param text: specs
+    :return: list of ThumbSpec
+    :raise ValueError: if a spec is not valid
+    """
+    specs = []
+    for spec_text in text.split(","):
+        fields = spec_text.strip().lower().split(":")
+        width, _, height = fields[0].partition("x")
+        width, height = int(width), int(height)
+        mode, image_format, quality = DEFAULT_THUMB_SPEC.mode, DEFAULT_THUMB_SPEC.format, DEFAULT_THUMB_SPEC.quality
+        for field in fields[1:]:
+            if field in THUMB_MODES:
+                mode = field
+            elif field in THUMB_FORMATS:
+                image_format = THUMB_FORMATS[field]
+            else:
+                quality = int(field)
+        if width <= 0 or height <= 0 or not 1 <= quality <= 100:
+            raise ValueError("invalid thumbnail spec '" + spec_text + "'")
+        suffix = "" if len(specs) == 0 else "_" + str(width) + "x" + str(height)
+        if any(spec.suffix == suffix and spec.format == image_format for spec in specs):
+            raise ValueError("duplicate thumbnail spec '" + spec_text + "'")
+        specs.append(ThumbSpec(width, height, mode, image_format, quality, suffix))
+    return specs
+
+
+def format_thumb_specs(specs):
+    """
+    Describe thumbnail specs, the opposite of parse_thumb_specs, default options are left out
+
+    :param specs: list of ThumbSpec
+    :return: specs text
+    """
+    texts = []
+    for spec in specs:
+        text = str(spec.width) + "x" + str(spec.height)
+        if spec.mode != DEFAULT_THUMB_SPEC.mode:
+            text += ":" + spec.mode
+        if spec.format != DEFAULT_THUMB_SPEC.format:
+            text += ":" + spec.format.lower()
+        if spec.quality != DEFAULT_THUMB_SPEC.quality:
+            text += ":" + str(spec.quality)
+        texts.append(text)
+    return ",".join(texts)
+
+
+def save_output(data, filename):
+    """
+    Save an output, creating its directory if needed (thumbnails)
+
+    :param data: encoded image
+    :param filename: path of the file to create
+    :return:
+    """
+    if not os.path.exists(os.path.dirname(filename)):
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)  # other workers may create it at the same time
+        except OSError:
+            sys.exit(
+                "Fatal : Directory '" + os.path.dirname(filename) + "' does not exist and cannot be created")
+
+    write_file(filename, data)
+
+
+def apply_profile(img, profile):
+    """
+    Rotate an image as its EXIF orientation says if the profile drops the EXIF data, so it is still displayed
+    the right way up
+
+    :param img: decoded image
+    :param profile: EncodingProfile
+    :return: rotated image, the image itself if it does not need to be rotated
+    """
+    if profile.exif or img.getexif().get(0x0112, 1) == 1:  # orientation tag
+        return img
+    return ImageOps.exif_transpose(img)
+
+
+def get_save_params(img, image_format, profile):
+    """
+    Get the Pillow save options of an encoding profile
+
+    :param img: original image, its metadata is kept if the profile says so
+    :param image_format: Pillow format name of the encoded image
+    :param profile: EncodingProfile
+    :return: dict of save options
+    """
+    params = {"icc_profile": img.info.get("icc_profile") if profile.icc else None}
+    if profile.exif and "exif" in img.info:
+        params["exif"] = img.info["exif"]
+    if profile.xmp and "xmp" in img.info and image_format in ("JPEG", "WEBP"):
+        params["xmp"] = img.info["xmp"]
+    if image_format == "JPEG":
+        params["optimize"] = True
+        params["progressive"] = profile.progressive
+        if profile.subsampling == "keep":
+            if img.format == "JPEG":
+                # The subsampling of the image itself, so it also applies to resized images
+                params["subsampling"] = JpegImagePlugin.get_sampling(img)
+        elif profile.subsampling is not None:
+            params["subsampling"] = profile.subsampling
+    elif image_format == "PNG":
+        params["compress_level"] = profile.png_level
+        params["optimize"] = profile.png_level == 9
+    return params
+
+
+def convert_for_format(img, image_format):
+    """
+    Convert an image to a mode the given format can encode, JPEG has no transparency and WebP no palette
+
+    :param img: image to encode
+    :param image_format: Pillow format name
+    :return: converted image, the image itself if the format can encode it
+    """
+    modes = FORMAT_MODES.get(image_format)
+    if modes is None or img.mode in modes:
+        return img
+    if "RGBA" in modes and ("A" in img.mode or "transparency" in img.info):
+        return img.convert("RGBA")
+    return img.convert("RGB")
+
+
+def get_webp_path(path):
+    """
+    Get the path of the WebP variant of an image, named like img.jpg.webp so web servers can pick it
+    when the browser accepts WebP, and images with the same name and different formats do not collide
+
+    :param path: image path
+    :return: WebP variant path
+    """
+    return path + ".webp"
+
+
+def add_webp_specs(specs, quality):
+    """
+    Add a WebP variant of each JPEG thumbnail spec, with the same size and name
+
+    :param specs: list of ThumbSpec
+    :param quality: quality of the WebP thumbnails
+    :return: list of ThumbSpec
+    """
+    return specs + [spec._replace(format="WEBP", quality=int(quality)) for spec in specs if spec.format == "JPEG"]
+
+
+def encode_image(img, image_format, **params):
+    """
+    Encode an image in memory
+
+    :param img: image to encode
+    :param image_format: Pillow format name
+    :param params: Pillow save options
+    :return: encoded image bytes
+    """
+    output = BytesIO()
+    img.save(output, image_format, **params)
+    return output.getvalue()
+
+
+def write_file(path, data):
+    """
+    Write a file to a temporary path then rename it, so an interrupted job never leaves a half written file
+
+    :param path: path of the file
+    :param data: file content
+    :return:
+    """
+    temp_path = get_temp_path(path)
+    try:
+        with open(temp_path, "wb") as file:
+            file.write(data)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    os.replace(temp_path, path)
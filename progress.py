@@ -0,0 +1,98 @@
+import time
+
+PROGRESS_INTERVAL = 0.1  # seconds between two progress events
+
+
+class Progress:
+    """
+    Count finished items per action and report them at a bounded rate, with the throughput and remaining time,
+    so the UI gets a few events per second whatever the number of files
+    """
+    def __init__(self, progress_signal, interval=PROGRESS_INTERVAL):
+        self.progress_signal = progress_signal  # emitted with (action, done, total, items/s, seconds left, task)
+        self.interval = interval
+        self.actions = {}  # {action: [done, total, start time, current task]}
+        self.changed = set()  # actions changed since the last event
+        self.last_emit = 0
+
+    def start(self, action, total):
+        """
+        Start counting an action
+
+        :param action: name of the action (scan, compress, thumb, zip)
+        :param total: number of items to process, 0 if unknown
+        :return:
+        """
+        self.actions[action] = [0, total, time.perf_counter(), ""]
+
+    def set_task(self, action, task):
+        """
+        Set what is being processed, only the last one is reported
+
+        :param action: name of the action
+        :param task: text describing the item being processed
+        :return:
+        """
+        self.actions[action][3] = task
+        self.changed.add(action)
+        self.emit()
+
+    def add(self, action, count=1):
+        """
+        Count finished (or skipped) items
+
+        :param action: name of the action
+        :param count: number of items
+        :return: True if an event was emitted
+        """
+        self.actions[action][0] += count
+        self.changed.add(action)
+        return self.emit()
+
+    def finish(self, action, task):
+        """
+        Report the final state of an action right away
+
+        :param action: name of the action
+        :param task: text describing how the action ended
+        :return:
+        """
+        self.actions[action][3] = task
+        self.changed.add(action)
+        self.emit(force=True)
+
+    def emit(self, force=False):
+        """
+        Emit the changed actions, if the last event is old enough
+
+        :param force: emit even if the last event is recent
+        :return: True if an event was emitted
+        """
+        now = time.perf_counter()
+        if not force and now - self.last_emit < self.interval:
+            return False
+        self.last_emit = now
+        for action in self.changed:
+            done, total, start, task = self.actions[action]
+            rate = done / (now - start) if now > start else 0.0
+            remaining = (total - done) / rate if total > 0 and rate > 0 else -1.0
+            self.progress_signal.emit(action, done, total, rate, remaining, task)
+        self.changed.clear()
+        return True
+
+
+def format_progress(done, total, rate, remaining):
+    """
+    Describe the progress of an action for the UI
+
+    :param done: items processed
+    :param total: items to process, 0 if unknown
+    :param rate: items per second
+    :param remaining: seconds left, negative if unknown
+    :return: text like "12/40 - 3.2/s - reste 0:09"
+    """
+    text = str(done) + ("/" + str(total) if total > 0 else "") + " - " + str(round(rate, 1)) + "/s"
+    if remaining >= 0:
+        minutes, seconds = divmod(int(remaining), 60)
+        text += " - reste " + str(minutes) + ":" + str(seconds).zfill(2)
+    return text
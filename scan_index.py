@@ -0,0 +1,71 @@
+import json
+import os
+import sqlite3
+import time
+
+from manifest import MANIFEST_NAME
+from utils import ImageStat
+
+RACY_TIME = 2.0  # seconds: a directory modified this recently may change again within the same mtime, it is relisted
+
+
+class ScanIndex:
+    """
+    Persistent listing of the directories of a gallery, stored in the manifest database,
+    so a rescan only lists the directories whose modification time changed
+    A directory modification time changes when files are added, removed or renamed, not when a file is rewritten
+    in place: such a file keeps its indexed size and modification time until a full scan lists its directory
+    """
+    def __init__(self, parent_path):
+        self.path = os.path.join(parent_path, MANIFEST_NAME)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS directories (path TEXT PRIMARY KEY, mtime INTEGER, "
+                                "is_valid INTEGER, images TEXT, sub_dirs TEXT)")
+        # {path: (mtime, is_valid, images, sub_dirs)}, read at once: one query is much faster than one per directory
+        self.rows = {row[0]: row[1:] for row in self.connection.execute("SELECT * FROM directories")}
+        self.seen = set()  # directories listed or found in the index during this scan
+
+    def close(self, is_complete):
+        """
+        Write the listings and close the index
+
+        :param is_complete: the whole tree was scanned, directories not seen are removed from the index
+        :return:
+        """
+        if is_complete:
+            stale = [(path,) for path in self.rows if path not in self.seen]
+            self.connection.executemany("DELETE FROM directories WHERE path = ?", stale)
+        self.connection.commit()
+        self.connection.close()
+
+    def get(self, path, mtime):
+        """
+        Get the listing of a directory, if it did not change since it was indexed
+
+        :param path: directory
+        :param mtime: current modification time of the directory in nanoseconds
+        :return: ({image name: ImageStat}, sub directories paths, is valid), None if the directory must be listed
+        """
+        self.seen.add(path)
+        row = self.rows.get(path)
+        if row is None or row[0] != mtime:
+            return None
+        files = {name: ImageStat(*stat) for name, stat in json.loads(row[2]).items()}
+        return files, json.loads(row[3]), bool(row[1])
+
+    def put(self, path, mtime, files, sub_dirs, is_valid):
+        """
+        Index the listing of a directory
+
+        :param path: directory
+        :param mtime: modification time of the directory in nanoseconds, taken before listing it
+        :param files: {image name: ImageStat}
+        :param sub_dirs: sub directories paths
+        :param is_valid: the directory is not hidden and contains images
+        :return:
+        """
+        self.seen.add(path)
+        if time.time() - mtime / 1e9 < RACY_TIME:
+            mtime = None  # never matches, the directory is listed again on the next scan
+        self.connection.execute("INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?, ?)",
+                                (path, mtime, is_valid, json.dumps(files), json.dumps(sub_dirs)))
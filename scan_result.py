@@ -0,0 +1,45 @@
+import os
+
+
+class ScanResult:
+    """
+    Images found by a scan, grouped by directory: each image name is stored once, without its directory path,
+    and counts are kept up to date so removing a directory or counting images does not go through every image
+    """
+    def __init__(self, images=None):
+        self.images = images if images is not None else {}  # {directory: {image name: ImageStat}}, in scan order
+        self.image_count = sum(len(files) for files in self.images.values())
+        self.image_list = ImageList(self)
+
+    def get_dir_list(self):
+        """
+        :return: list of the directories, in scan order
+        """
+        return list(self.images)
+
+    def remove_dir(self, path):
+        """
+        Remove a directory and its images, its sub directories are kept
+
+        :param path: directory to remove, ignored if it is not in the result
+        :return:
+        """
+        files = self.images.pop(path, None)
+        if files is not None:
+            self.image_count -= len(files)
+
+
+class ImageList:
+    """
+    Read only view of the image paths of a ScanResult, paths are only built while iterating
+    """
+    def __init__(self, scan_result):
+        self.scan_result = scan_result
+
+    def __len__(self):
+        return self.scan_result.image_count
+
+    def __iter__(self):
+        for path, files in self.scan_result.images.items():
+            for name in files:
+                yield os.path.join(path, name)
@@ -1,29 +1,23 @@
 import os
+import sqlite3
 
-from PyQt5.QtCore import pyqtSlot, QRunnable, pyqtSignal, QObject
+from events import ScannerEvents
+from progress import Progress
+from scan_index import ScanIndex
+from scan_result import ScanResult
+from utils import is_directory_valid, is_file_valid_image, ImageStat
 
-from utils import is_directory_valid, get_images_in_dir
 
-
-class ScannerSignals(QObject):
-    """
-    Store thread signal for communication with the UI
-    """
-    scan_finished_signal = pyqtSignal(list, list)  # thread has finished
-    scanned_dir_signal = pyqtSignal(str)  # thread scanned a directory
-    scanned_dir_finished = pyqtSignal()  # all directories scanned
-    scanned_images_signal = pyqtSignal(str)  # scanned a folder for images
-    new_scan_task_started = pyqtSignal(str)  # update ui
-
-
-class Scanner(QRunnable):
+class Scanner:
     """
-    Scan operations thread
+    Scan operations, run in a thread by the UI or directly from the command line
     """
-    def __init__(self, path):
-        super(Scanner, self).__init__()
-        self.path = path
-        self.signals = ScannerSignals()
+    def __init__(self, path, signals=None, use_index=False):
+        self.path = os.path.normpath(path) if path else path  # no trailing separator, the keys match os.path.dirname
+        self.signals = signals if signals is not None else ScannerEvents()
+        self.progress = Progress(self.signals.progress_signal)
+        self.use_index = use_index  # reuse the listing of directories unchanged since the last scan
+        self.index = None
         self.should_stop = False
 
     def stop(self):
@@ -40,51 +34,94 @@ class Scanner(QRunnable):
         """
         return self.should_stop
 
-    @pyqtSlot()
-    def get_directories_list(self, path):
+    def scan_directories(self, path):
         """
-        Tell the user which folders will be compressed, and asks for confirmation
+        Walk the directory tree once and get the images of each valid directory (not hidden and with images)
+        Sub directories are listed in the same pass, so no directory is listed twice
+        Directories found are sent to the UI in batches, along with the progress
+
         :param path: Root path for search
-        :return: True if user confirmed, False otherwise
+        :return: dict of {directory: {image name: ImageStat}}, in os.walk order
         """
-        dir_list = []
-        self.signals.new_scan_task_started.emit("Scan des sous dossiers...")
-        for root, dirs, files in os.walk(path):
+        images = {}
+        found = []  # directories found since the last scanned_dir_signal
+        self.progress.start("scan", 0)
+        self.progress.set_task("scan", "Scan des sous dossiers...")
+        stack = [path]
+        while stack:
             if self.is_aborted():
                 break
+            root = stack.pop()
+            try:
+                files, sub_dirs, is_valid = self.list_dir(root)
+            except OSError:
+                continue  # unreadable directories are ignored, like os.walk does
+            if is_valid:
+                images[root] = files
+                found.append(root)
+            # Hidden directories and their children are never valid
+            stack.extend(sub_dir for sub_dir in reversed(sub_dirs) if not os.path.basename(sub_dir).startswith("."))
+            if self.progress.add("scan") and len(found) > 0:
+                self.signals.scanned_dir_signal.emit(found)
+                found = []
+        if len(found) > 0:
+            self.signals.scanned_dir_signal.emit(found)
+        return images
 
-            if is_directory_valid(root, files):
-                dir_list.append(root)
-                self.signals.scanned_dir_signal.emit(root)
-        self.signals.scanned_dir_finished.emit()
-        return dir_list
-
-    @pyqtSlot()
-    def get_images_in_dir_list(self, dir_list):
+    def list_dir(self, path):
         """
-        get images in the folder list specified
+        List a directory, or get its listing from the index if it did not change since the last scan
 
-        :param dir_list: list of directories to look for images in
-        :return: images list
+        :param path: directory to list
+        :return: ({image name: ImageStat}, sub directories paths, True if the directory is valid)
         """
-        images_list = []
-        for path in dir_list:
-            if self.is_aborted():
-                break
-            print("Finding images in '" + path + "'", end="")
-            self.signals.new_scan_task_started.emit("Recherche d'images dans le dossier '" + path + "'...")
-            images_list += get_images_in_dir(path)
-            print("done")
-            self.signals.scanned_images_signal.emit(path)
-
-        return images_list
+        if self.index is not None:
+            mtime = os.stat(path).st_mtime_ns
+            listing = self.index.get(path, mtime)
+            if listing is not None:
+                return listing
+        files, sub_dirs = scan_dir(path)
+        is_valid = len(files) > 0 and is_directory_valid(path, files)
+        if self.index is not None:
+            self.index.put(path, mtime, files, sub_dirs, is_valid)
+        return files, sub_dirs, is_valid
 
-    @pyqtSlot()
     def run(self):
-        dir_list = self.get_directories_list(self.path)
-        image_list = self.get_images_in_dir_list(dir_list)
+        if self.use_index:
+            try:
+                self.index = ScanIndex(self.path)
+            except sqlite3.Error as e:
+                print("Cannot open the scan index, every directory will be listed: " + str(e))
+        images = self.scan_directories(self.path)
+        if self.index is not None:
+            self.index.close(not self.is_aborted())
+            self.index = None
         if self.is_aborted():
-            self.signals.new_scan_task_started.emit("Scan Annulé")
+            self.progress.finish("scan", "Scan Annulé")
         else:
-            self.signals.new_scan_task_started.emit("Scan Terminé")
-        self.signals.scan_finished_signal.emit(dir_list, image_list)
+            self.progress.finish("scan", "Scan Terminé")
+        self.signals.scan_finished_signal.emit(ScanResult(images))
+
+
+def scan_dir(path):
+    """
+    List a directory once: get its images with their size and modification time, and its sub directories
+    Symbolic links to directories are not followed, like os.walk does
+
+    :param path: directory to list
+    :return: ({image name: ImageStat}, sub directories paths)
+    """
+    files = {}
+    sub_dirs = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        sub_dirs.append(entry.path)
+                elif is_file_valid_image(entry.name):
+                    stat = entry.stat()
+                    files[entry.name] = ImageStat(stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                continue  # broken link or file removed during the scan
+    return files, sub_dirs
@@ -0,0 +1,100 @@
+import json
+import os
+import time
+from io import BytesIO
+
+from PIL import Image
+
+from processing import encode_image, convert_for_format, get_save_params, save_output
+
+SPRITE_DIR = ".sprites"  # hidden, so scans skip it and no gallery directory can share its name
+SPRITE_NAME = "sprites"  # sheets are named sprites_0.jpg, sprites_1.jpg... next to the map sprites.json
+MAX_SHEET_SIZE = 2048  # largest width and height of a sheet, most browsers and GPUs handle this size
+SHEET_EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png", "WEBP": ".webp"}
+
+
+def get_sprite_dir(thumb_dir):
+    """
+    :param thumb_dir: thumbnail directory of a gallery directory
+    :return: directory of its sprite sheets and their map, apart from the thumbnails
+    """
+    return os.path.join(thumb_dir, SPRITE_DIR)
+
+
+def get_sprite_map_path(thumb_dir):
+    """
+    :param thumb_dir: thumbnail directory of a gallery directory
+    :return: path of the JSON map of its sprite sheets
+    """
+    return os.path.join(get_sprite_dir(thumb_dir), SPRITE_NAME + ".json")
+
+
+def pack_shelves(sizes, max_size=MAX_SHEET_SIZE):
+    """
+    Place rectangles on shelves: rows filled from left to right, tallest rectangles first so each row
+    wastes little height, and a new sheet is started when the current one is full
+
+    :param sizes: list of (width, height), each at most max_size
+    :param max_size: largest width and height of a sheet
+    :return: (list of (sheet index, x, y) in the order of sizes, list of (width, height) of each sheet)
+    """
+    positions = [None] * len(sizes)
+    sheets = []
+    x = y = shelf_height = 0
+    for i in sorted(range(len(sizes)), key=lambda i: -sizes[i][1]):
+        width, height = sizes[i]
+        if x + width > max_size:
+            x, y, shelf_height = 0, y + shelf_height, 0
+        if len(sheets) == 0 or y + height > max_size:
+            sheets.append([0, 0])
+            x = y = shelf_height = 0
+        positions[i] = (len(sheets) - 1, x, y)
+        sheets[-1] = [max(sheets[-1][0], x + width), max(sheets[-1][1], y + height)]
+        x += width
+        shelf_height = max(shelf_height, height)
+    return positions, [tuple(sheet) for sheet in sheets]
+
+
+def make_sprites(thumb_dir, thumbs, spec, profile):
+    """
+    Pack the thumbnails of a directory into sprite sheets, and write the map of where each one is:
+    {image name: {"sheet": file name, "x", "y", "w", "h"}}
+    Sheets of a previous run that are not needed anymore are removed
+
+    :param thumb_dir: thumbnail directory, the sheets and the map are written to its sprite directory
+    :param thumbs: list of (image name, encoded thumbnail)
+    :param spec: ThumbSpec of the thumbnails, its format and quality are used for the sheets
+    :param profile: EncodingProfile of the sheets
+    :return: measures: seconds spent and bytes read and written, see RunStats.add_measures
+    """
+    start = time.perf_counter()
+    images = [Image.open(BytesIO(data)) for name, data in thumbs]
+    positions, sheet_sizes = pack_shelves([img.size for img in images])
+    mode = "RGB" if spec.format == "JPEG" else "RGBA"
+    sheets = [Image.new(mode, size, "white" if mode == "RGB" else (0, 0, 0, 0)) for size in sheet_sizes]
+    sheet_names = [SPRITE_NAME + "_" + str(i) + SHEET_EXTENSIONS[spec.format] for i in range(len(sheets))]
+    sprite_map = {}
+    for (name, data), img, (sheet, x, y) in zip(thumbs, images, positions):
+        sheets[sheet].paste(convert_for_format(img, spec.format).convert(mode), (x, y))
+        sprite_map[name] = {"sheet": sheet_names[sheet], "x": x, "y": y, "w": img.size[0], "h": img.size[1]}
+    sprite_dir = get_sprite_dir(thumb_dir)
+    output_bytes = 0
+    for sheet, sheet_name in zip(sheets, sheet_names):
+        data = encode_image(convert_for_format(sheet, spec.format), spec.format, quality=spec.quality,
+                            **get_save_params(sheet, spec.format, profile))
+        save_output(data, os.path.join(sprite_dir, sheet_name))
+        output_bytes += len(data)
+    map_path = get_sprite_map_path(thumb_dir)
+    old_names = set()
+    if os.path.exists(map_path):
+        try:
+            with open(map_path, encoding="utf-8") as file:
+                old_names = {entry["sheet"] for entry in json.load(file).values()}
+        except (ValueError, KeyError, TypeError, AttributeError, OSError):
+            pass  # unreadable map, its sheets are overwritten or left behind
+    save_output(json.dumps(sprite_map, separators=(",", ":")).encode(), map_path)
+    for old_name in old_names - set(sheet_names):
+        if os.path.basename(old_name) == old_name and os.path.exists(os.path.join(sprite_dir, old_name)):
+            os.remove(os.path.join(sprite_dir, old_name))
+    return {"sprite": time.perf_counter() - start, "sprite_input_bytes": sum(len(data) for name, data in thumbs),
+            "sprite_output_bytes": output_bytes}
@@ -0,0 +1,147 @@
+import heapq
+import json
+import time
+
+TOP_COUNT = 20  # number of slowest images and directories kept in the report
+
+
+class RunStats:
+    """
+    Measures of an optimisation run: time spent in each stage, bytes read and written, and failures
+    Per image measures are aggregated by directory, only the slowest images are kept individually,
+    so memory use does not grow with the gallery size
+    """
+    def __init__(self, hook=None, hook_interval=1.0):
+        self.hook = hook  # called with get_report() at most every hook_interval seconds
+        self.hook_interval = hook_interval
+        self.last_hook = 0
+        self.start = time.perf_counter()
+        self.end = None
+        self.stages = {}  # {stage: {"seconds": float, "count": int}}
+        self.bytes = {}  # {action: {"input": int, "output": int}}
+        self.read_bytes = 0  # bytes read from the gallery
+        self.counts = {}  # {action: {"processed": int, "skipped": int, "failed": int}}
+        self.kept = 0  # images left untouched because they were already compressed enough
+        self.directories = {}  # {directory: {"seconds": float, "count": int}}
+        self.slowest = []  # heap of (seconds, path, action)
+        self.failures = []
+
+    def add_measures(self, action, path, directory, measures):
+        """
+        Add the measures of one processed image or directory
+
+        :param action: name of the action (image, zip)
+        :param path: image or directory
+        :param directory: directory the measures are aggregated in
+        :param measures: {stage: seconds}, {action + "_input_bytes"/"_output_bytes": bytes}, "read_bytes"
+                         and "compress_kept"
+        :return:
+        """
+        total = 0
+        for key, value in measures.items():
+            if key == "read_bytes":
+                self.read_bytes += value
+            elif key == "compress_kept":
+                self.kept += value
+            elif key.endswith("_input_bytes") or key.endswith("_output_bytes"):
+                output_action, _, direction = key[:-len("_bytes")].rpartition("_")
+                action_bytes = self.bytes.setdefault(output_action, {"input": 0, "output": 0})
+                action_bytes[direction] += value
+            else:
+                stage = self.stages.setdefault(key, {"seconds": 0.0, "count": 0})
+                stage["seconds"] += value
+                stage["count"] += 1
+                total += value
+        directory_values = self.directories.setdefault(directory, {"seconds": 0.0, "count": 0})
+        directory_values["seconds"] += total
+        directory_values["count"] += 1
+        self.count(action, "processed")
+        heapq.heappush(self.slowest, (total, path, action))
+        if len(self.slowest) > TOP_COUNT:
+            heapq.heappop(self.slowest)
+        self.call_hook()
+
+    def add_skipped(self, action):
+        """
+        Count an image or directory skipped because it was already processed
+
+        :param action: name of the action (image, zip)
+        :return:
+        """
+        self.count(action, "skipped")
+        self.call_hook()
+
+    def add_failure(self, action, path, error):
+        """
+        Record an image or directory that could not be processed
+
+        :param action: name of the action (image, zip)
+        :param path: image or directory
+        :param error: exception raised
+        :return:
+        """
+        self.count(action, "failed")
+        self.failures.append({"path": path, "action": action, "error": type(error).__name__ + ": " + str(error)})
+        self.call_hook()
+
+    def count(self, action, result):
+        """
+        Increment the count of an action result
+
+        :param action: name of the action (image, zip)
+        :param result: processed, skipped or failed
+        :return:
+        """
+        self.counts.setdefault(action, {"processed": 0, "skipped": 0, "failed": 0})[result] += 1
+
+    def finish(self):
+        """
+        Stop the run clock and call the hook a last time
+        :return:
+        """
+        self.end = time.perf_counter()
+        self.call_hook(force=True)
+
+    def call_hook(self, force=False):
+        """
+        Give the current report to the live stats hook, at a bounded rate
+
+        :param force: call the hook even if it was called recently
+        :return:
+        """
+        now = time.perf_counter()
+        if self.hook is not None and (force or now - self.last_hook >= self.hook_interval):
+            self.last_hook = now
+            self.hook(self.get_report())
+
+    def get_report(self):
+        """
+        :return: report of the run, as a dict ready to be written as JSON
+        """
+        seconds = (self.end if self.end is not None else time.perf_counter()) - self.start
+        return {
+            "seconds": seconds,
+            "counts": {action: dict(values) for action, values in self.counts.items()},
+            "kept": self.kept,
+            "images_per_sec": self.counts.get("image", {}).get("processed", 0) / seconds if seconds > 0 else None,
+            "read_mb_per_sec": self.read_bytes / 1000000 / seconds if seconds > 0 else None,
+            "stages": {stage: dict(values) for stage, values in self.stages.items()},
+            "bytes": {action: dict(values, saved=values["input"] - values["output"])
+                      for action, values in self.bytes.items()},
+            "slowest": [{"path": path, "action": action, "seconds": total}
+                        for total, path, action in sorted(self.slowest, reverse=True)],
+            "slowest_directories": [{"path": path, "seconds": values["seconds"], "count": values["count"]}
+                                    for path, values in heapq.nlargest(TOP_COUNT, self.directories.items(),
+                                                                       key=lambda item: item[1]["seconds"])],
+            "failures": list(self.failures),
+        }
+
+    def write(self, path):
+        """
+        Write the report to a JSON file
+
+        :param path: file to write
+        :return:
+        """
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(self.get_report(), file, indent=2)
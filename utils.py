@@ -1,7 +1,8 @@
 import os
 import sys
+from collections import namedtuple
 
-from PyQt5.QtWidgets import QFileDialog
+ImageStat = namedtuple("ImageStat", ["size", "mtime"])  # size in bytes, modification time in nanoseconds
 
 
 def get_new_path(img, parent_path, thumb_path):
@@ -15,6 +16,16 @@ def get_new_path(img, parent_path, thumb_path):
     return img.replace(parent_path, thumb_path, 1)
 
 
+def get_temp_path(path):
+    """
+    Get the temporary path an output is written to before being renamed to its final path
+    The temporary file is hidden and does not look like an image, so scans ignore it
+    :param path: final path
+    :return: temporary path, in the same directory so the rename is atomic
+    """
+    return os.path.join(os.path.dirname(path), "." + os.path.basename(path) + ".tmp")
+
+
 def is_file_valid_image(file):
     return file.endswith("png") or file.endswith("PNG") or file.endswith("jpg") or file.endswith("JPG") or file.endswith("JPEG") or file.endswith("jpeg")
 
@@ -50,49 +61,6 @@ def get_current_dir(path):
     return os.path.basename(os.path.normpath(path))
 
 
-def get_images_in_dir(path):
-    """
-    get images in the folder specified (hidden and empty folders are ignored)
-    sub folders are ignored
-    :param path: directory to get images in
-    :return: images list
-    """
-    images_list = []
-    files_list = os.listdir(path)
-    for fn in files_list:
-        if is_file_valid_image(fn):
-            images_list.append(os.path.join(path, fn))
-    return images_list
-
-
-def create_file_dialog():
-    """
-    Create a file dialog object, ready to use
-    :return:
-    """
-    dialog = QFileDialog()
-    dialog.setFileMode(QFileDialog.DirectoryOnly)
-    options = QFileDialog.Options()
-    options |= QFileDialog.DontUseNativeDialog
-    options |= QFileDialog.ShowDirsOnly
-    dialog.setOptions(options)
-    return dialog
-
-
-def remove_images_from_folders(folder: str, images_list: list):
-    """
-    Remove images in the specified folder, subfolders are ignored
-    :param folder: folder to remove images from
-    :param images_list: list of images to edit
-    :return: edited image list
-    """
-    new_list = []
-    for img in images_list:
-        if folder != os.path.dirname(img):
-            new_list.append(img)
-    return new_list
-
-
 def resource_path(relative_path):
     """ Get absolute path to resource, works for dev and for PyInstaller """
     base_path = getattr(sys, '_MEIPASS', os.getcwd())
@@ -0,0 +1,260 @@
+import os
+import threading
+import time
+
+from scan_index import RACY_TIME
+from scanner import Scanner, scan_dir
+from utils import is_directory_valid
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # optional, directories are polled without it
+    FileSystemEventHandler = object
+    Observer = None
+
+POLL_INTERVAL = 2.0  # seconds between two checks of the gallery
+SETTLE_TIME = 2.0  # seconds a file must stay unchanged before it is processed, so files being copied are not read
+
+
+class Watcher:
+    """
+    Watch a gallery and optimize images as they are added or changed, until stopped
+    Changes are found with filesystem notifications when watchdog is installed, by polling the gallery otherwise
+    Only new or changed images are processed, and the zips of their directories updated
+    """
+    def __init__(self, path, images, make_optimizer, exclude=None, interval=POLL_INTERVAL, settle=SETTLE_TIME,
+                 use_notifications=True):
+        self.path = path
+        # {directory: {image name: ImageStat}} of the images already processed, shared with the optimizers
+        self.images = images
+        self.make_optimizer = make_optimizer  # make_optimizer(dir_list, image_list, images): ImageOptimizer
+        self.exclude = exclude  # directory never watched, where thumbnails are saved
+        self.interval = interval
+        self.settle = settle
+        self.use_notifications = use_notifications and Observer is not None
+        self.pending = {}  # {image path: (ImageStat, time of the last change)} waiting for the file to settle
+        self.changed_dirs = set()  # directories whose zip must be updated
+        self.handler = None
+        self.listings = ListingCache()  # directories listed by the previous polls
+        self.optimizer = None  # optimizer of the batch being processed
+        self.should_stop = False
+        self.stopped = threading.Event()
+
+    def stop(self):
+        """
+        stop watching, the batch being processed is aborted
+        :return:
+        """
+        self.should_stop = True
+        self.stopped.set()
+        if self.optimizer is not None:
+            self.optimizer.stop()
+
+    def is_aborted(self):
+        """
+        Check if the watcher was stopped
+        :return: True is the watcher was stopped, false otherwise
+        """
+        return self.should_stop
+
+    def run(self):
+        observer = None
+        if self.use_notifications:
+            self.handler = ChangeHandler()
+            observer = Observer()
+            observer.schedule(self.handler, self.path, recursive=True)
+            observer.start()
+            print("Watching '" + self.path + "' for changes...")
+        else:
+            print("Watching '" + self.path + "' for changes every " + str(self.interval) + "s (install watchdog to "
+                  "be notified of changes instead)...")
+        try:
+            while not self.is_aborted():
+                self.find_changes()
+                self.process_settled()
+                self.stopped.wait(self.interval if len(self.pending) == 0 else min(self.interval, self.settle))
+        finally:
+            if observer is not None:
+                observer.stop()
+                observer.join()
+
+    def find_changes(self):
+        """
+        Rescan the directories that may have changed: the ones notified, or when polling the ones whose
+        modification time changed, and add new or changed images to the pending ones
+        :return:
+        """
+        if self.handler is None:
+            self.update_tree(self.path, self.listings)
+            self.listings.prune()
+            return
+        dirs, trees = self.handler.get_changes()
+        for path in trees:
+            self.update_tree(path)
+        for path in dirs - trees:
+            try:
+                files = scan_dir(path)[0]
+            except OSError:
+                files = {}  # removed since the notification
+            self.update_dir(path, files if is_directory_valid(path, files) else {})
+
+    def update_tree(self, path, index=None):
+        """
+        Rescan a directory and its sub directories
+        :param path: root of the directories to rescan
+        :param index: ListingCache of the directories unchanged since the last rescan, None to list them all
+        :return:
+        """
+        scanner = Scanner(path)
+        scanner.index = index
+        found = scanner.scan_directories(path)
+        prefix = os.path.join(path, "")
+        for dir_path in list(self.images):
+            if (dir_path == path or dir_path.startswith(prefix)) and dir_path not in found:
+                self.update_dir(dir_path, {})
+        for dir_path, files in found.items():
+            self.update_dir(dir_path, files)
+
+    def update_dir(self, path, files):
+        """
+        Compare the images of a directory to the ones already processed
+
+        :param path: directory
+        :param files: {image name: ImageStat} currently in the directory, empty if it is gone or not valid anymore
+        :return:
+        """
+        if self.is_excluded(path):
+            return
+        known = self.images.setdefault(path, {})
+        now = time.monotonic()
+        for name, stat in files.items():
+            if known.get(name) != stat:
+                image_path = os.path.join(path, name)
+                previous = self.pending.get(image_path)
+                if previous is None or previous[0] != stat:
+                    self.pending[image_path] = (stat, now)  # the settle time starts again at each change
+        for name in set(known) - set(files):
+            # Removed images are not processed, but the zip of the directory must not contain them anymore
+            del known[name]
+            self.pending.pop(os.path.join(path, name), None)
+            self.changed_dirs.add(path)
+        if len(known) == 0 and not any(os.path.dirname(image_path) == path for image_path in self.pending):
+            del self.images[path]
+            self.changed_dirs.discard(path)
+
+    def is_excluded(self, path):
+        """
+        :param path: directory
+        :return: True if the directory is in the excluded one
+        """
+        return self.exclude is not None and (path == self.exclude or path.startswith(os.path.join(self.exclude, "")))
+
+    def process_settled(self):
+        """
+        Optimize the pending images that did not change for the settle time, in one batch
+        :return:
+        """
+        now = time.monotonic()
+        settled = {path: stat for path, (stat, changed) in self.pending.items() if now - changed >= self.settle}
+        if len(settled) == 0 and (len(self.changed_dirs) == 0 or len(self.pending) > 0):
+            return
+        image_list = sorted(settled)
+        for path in image_list:
+            del self.pending[path]
+            self.changed_dirs.add(os.path.dirname(path))
+        # The directory images are shared, so the optimizer updates them when it compresses an image
+        # and the compressed image is not seen as a change
+        images = {path: self.images.setdefault(path, {}) for path in self.changed_dirs}
+        for path in image_list:
+            images[os.path.dirname(path)][os.path.basename(path)] = settled[path]
+        dir_list = sorted(path for path in self.changed_dirs if len(images[path]) > 0)
+        self.changed_dirs = set()
+        print(str(len(image_list)) + " new or changed images in " + str(len(dir_list)) + " directories")
+        self.optimizer = self.make_optimizer(dir_list, image_list, images)
+        if self.is_aborted():
+            return
+        self.optimizer.run()
+        self.optimizer = None
+
+
+class ListingCache:
+    """
+    Listing of the directories kept in memory between two polls, used by the scanner like a ScanIndex:
+    only the directories whose modification time changed are listed again, so an image rewritten in place
+    is only seen with filesystem notifications
+    """
+    def __init__(self):
+        self.rows = {}  # {path: (mtime, {image name: ImageStat}, sub directories paths, is valid)}
+        self.seen = set()  # directories listed or found in the cache during this poll
+
+    def get(self, path, mtime):
+        """
+        Get the listing of a directory, if it did not change since the last poll
+
+        :param path: directory
+        :param mtime: current modification time of the directory in nanoseconds
+        :return: ({image name: ImageStat}, sub directories paths, is valid), None if the directory must be listed
+        """
+        self.seen.add(path)
+        row = self.rows.get(path)
+        if row is None or row[0] != mtime:
+            return None
+        return row[1:]
+
+    def put(self, path, mtime, files, sub_dirs, is_valid):
+        """
+        Keep the listing of a directory
+
+        :param path: directory
+        :param mtime: modification time of the directory in nanoseconds, taken before listing it
+        :param files: {image name: ImageStat}
+        :param sub_dirs: sub directories paths
+        :param is_valid: the directory is not hidden and contains images
+        :return:
+        """
+        self.seen.add(path)
+        if time.time() - mtime / 1e9 < RACY_TIME:
+            mtime = None  # never matches, the directory is listed again on the next poll
+        self.rows[path] = (mtime, files, sub_dirs, is_valid)
+
+    def prune(self):
+        """
+        Forget the directories not seen during this poll, they were removed
+        :return:
+        """
+        self.rows = {path: row for path, row in self.rows.items() if path in self.seen}
+        self.seen = set()
+
+
+class ChangeHandler(FileSystemEventHandler):
+    """
+    Collect the directories changed according to the filesystem notifications, called from the observer thread
+    """
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.dirs = set()  # directories whose files changed
+        self.trees = set()  # directories created, moved or removed, to rescan with their sub directories
+
+    def on_any_event(self, event):
+        paths = [event.src_path, getattr(event, "dest_path", "")]
+        with self.lock:
+            for path in paths:
+                if not path:
+                    continue
+                if event.is_directory:
+                    if event.event_type != "modified":  # a directory is modified each time one of its files is
+                        self.trees.add(os.path.dirname(path) if event.event_type == "deleted" else path)
+                else:
+                    self.dirs.add(os.path.dirname(path))
+
+    def get_changes(self):
+        """
+        Get the directories changed since the last call
+        :return: (directories whose files changed, directories to rescan with their sub directories)
+        """
+        with self.lock:
+            dirs, trees = self.dirs, self.trees
+            self.dirs, self.trees = set(), set()
+        return dirs, trees
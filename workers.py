@@ -0,0 +1,31 @@
+from PyQt5.QtCore import QObject, QRunnable, pyqtSignal, pyqtSlot
+
+
+class OptimizerSignals(QObject):
+    """
+    Store thread signal for communication with the UI
+    """
+    finished_signal = pyqtSignal()  # thread has finished
+    progress_signal = pyqtSignal(str, int, int, float, float, str)  # batched progress, see Progress
+
+
+class ScannerSignals(QObject):
+    """
+    Store thread signal for communication with the UI
+    """
+    scan_finished_signal = pyqtSignal(object)  # thread has finished, with the ScanResult
+    scanned_dir_signal = pyqtSignal(list)  # directories found since the last event
+    progress_signal = pyqtSignal(str, int, int, float, float, str)  # batched progress, see Progress
+
+
+class Worker(QRunnable):
+    """
+    Run a Scanner or an ImageOptimizer in the Qt thread pool
+    """
+    def __init__(self, task):
+        super(Worker, self).__init__()
+        self.task = task
+
+    @pyqtSlot()
+    def run(self):
+        self.task.run()